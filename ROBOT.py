@@ -11,6 +11,8 @@ from typing import TYPE_CHECKING
 from coggers.variants import VariantCog
 from coggers.parser import ParserCog
 from coggers.data import DataCog
+from coggers.executor import RenderExecutorCog
+from coggers.render import RenderCog
 
 
 class Context(commands.Context):  # taken from ric
@@ -39,6 +41,8 @@ class Bot(commands.Bot):
     parser: ParserCog
     data: DataCog
     variant_handler: VariantCog
+    executor: RenderExecutorCog
+    renderer: RenderCog
 
     def __init__(self, *args, cogs, **kwargs):
         super().__init__(*args, **kwargs)
@@ -50,9 +54,11 @@ class Bot(commands.Bot):
         print("Bot is running!")
 
 
-intents = discord.Intents.default()
-intents.message_content = True
+# Render workers may re-import this module when they start, so don't run the bot for them
+if __name__ == "__main__":
+    intents = discord.Intents.default()
+    intents.message_content = True
 
-bot = Bot(cogs=config.cogs, command_prefix=config.prefix, intents=intents, allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False),)
+    bot = Bot(cogs=config.cogs, command_prefix=config.prefix, intents=intents, allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=False),)
 
-bot.run(auth.token, log_handler=None)
+    bot.run(auth.token, log_handler=None)
@@ -0,0 +1,140 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from cache import replacing
+from colors import ColorStats
+
+ATLAS_PATH = Path("data", "atlas.bin")
+INDEX_PATH = Path("data", "atlas.json")
+COLORS_PATH = Path("data", "atlas.colors.npy")
+# Each sprite's colors and how many pixels have them, from the most common to the least
+COLORS_DTYPE = np.dtype([("color", "<u4"), ("count", "<u4")])
+
+
+def atlas_sources(root: Path = Path("data")) -> list[tuple[str, Path]]:
+    """Gets every sprite that goes into the atlas, as (key, path).
+
+    Tile sprites are keyed by "<directory>/<file name>", and custom text letters by "letters/<char>/<file name>"."""
+    sources = []
+    for path in sorted(root.glob("*/sprites/*.png")):
+        if path.parent.parent.name != "special":
+            sources.append((f"{path.parent.parent.name}/{path.stem}", path))
+    for path in sorted(root.glob("special/letters/*/*.png")):
+        sources.append((f"letters/{path.parent.name}/{path.stem}", path))
+    return sources
+
+
+def source_path(key: str, root: Path = Path("data")) -> Path:
+    """Gets the file that the sprite under an atlas key was packed from."""
+    if key.startswith("letters/"):
+        _, char, stem = key.split("/")
+        return root / "special" / "letters" / char / (stem + ".png")
+    directory, stem = key.split("/")
+    return root / directory / "sprites" / (stem + ".png")
+
+
+def build_atlas(root: Path = Path("data")):
+    """Packs every sprite into one raw RGBA file, with the colors of each one in another
+    and a JSON index of where each one is in both, and when its file was last changed.
+
+    Each file is written to the side and then moved over the old one, the index last. Processes that have
+    the old atlas mapped keep reading the old file, and processes that load it afterwards get the new one.
+    If packing fails, the old atlas is left as it was."""
+    index = {}
+    offset = 0
+    histograms = []
+    colors_offset = 0
+    # The innermost file is moved into place first
+    with (
+        replacing(root / INDEX_PATH.name, "w") as f,
+        replacing(root / COLORS_PATH.name) as colors,
+        replacing(root / ATLAS_PATH.name) as atlas
+    ):
+        for key, path in atlas_sources(root):
+            with Image.open(path) as im:
+                img = im.convert("RGBA")
+            atlas.write(img.tobytes())
+            stats = ColorStats.of(np.asarray(img))
+            histogram = np.empty(len(stats.colors), dtype=COLORS_DTYPE)
+            histogram["color"], histogram["count"] = stats.colors, stats.counts
+            histograms.append(histogram)
+            index[key] = (offset, img.width, img.height, colors_offset, len(histogram), path.stat().st_mtime_ns)
+            offset += img.width * img.height * 4
+            colors_offset += len(histogram)
+        np.save(colors, np.concatenate(histograms) if len(histograms) else np.zeros(0, dtype=COLORS_DTYPE))
+        json.dump(index, f)
+    return len(index)
+
+
+class Atlas:
+    """The packed sprites, memory mapped so that every process rendering shares the same pages.
+
+    Sprites whose files have changed since the atlas was built are left out, so that they're read from their files."""
+
+    def __init__(self, path: Path = ATLAS_PATH, index_path: Path = INDEX_PATH, colors_path: Path = COLORS_PATH):
+        with open(index_path) as f:
+            # (offset, width, height), then (colors offset, color count, file mtime) for atlases built with them
+            self.index: dict[str, tuple[int, ...]] = json.load(f)
+        # The keys that were left out for being out of date
+        self.stale: list[str] = []
+        for key, entry in list(self.index.items()):
+            if len(entry) < 6:
+                continue
+            try:
+                changed = source_path(key, index_path.parent).stat().st_mtime_ns != entry[5]
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                del self.index[key]
+                self.stale.append(key)
+        if path.stat().st_size:
+            self.blob = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+        else:
+            # Empty files can't be mapped
+            self.blob = np.zeros(0, dtype=np.uint8)
+        # Views are handed out once each, so that the same sprite is always the same array
+        self.views: dict[str, np.ndarray] = {}
+        self.histograms: np.ndarray | None = None
+        if colors_path.exists():
+            self.histograms = np.load(colors_path, mmap_mode="r")
+        self.stats: dict[str, ColorStats] = {}
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Gets a sprite as a read only RGBA array, without copying it."""
+        view = self.views.get(key)
+        if view is None:
+            if key not in self.index:
+                return None
+            offset, width, height = self.index[key][:3]
+            view = self.blob[offset:offset + width * height * 4].reshape(height, width, 4)
+            self.views[key] = view
+        return view
+
+    def color_stats(self, key: str) -> ColorStats | None:
+        """Gets the color statistics of a sprite, if the atlas was built with them."""
+        stats = self.stats.get(key)
+        if stats is None:
+            entry = self.index.get(key)
+            if entry is None or len(entry) < 5 or self.histograms is None:
+                return None
+            colors_offset, count = entry[3:5]
+            histogram = self.histograms[colors_offset:colors_offset + count]
+            stats = ColorStats.from_histogram(np.array(histogram["color"]), np.array(histogram["count"]))
+            self.stats[key] = stats
+        return stats
+
+    def keys(self, prefix: str = "") -> list[str]:
+        return [key for key in self.index if key.startswith(prefix)]
+
+
+def load_atlas() -> Atlas | None:
+    """Loads the atlas if setup.py has built one."""
+    if not (ATLAS_PATH.exists() and INDEX_PATH.exists()):
+        return None
+    return Atlas()
@@ -0,0 +1,29 @@
+import random
+
+from coggers.executor import RenderWorker
+from coggers.parser import ParserCog
+
+
+def make_bot() -> RenderWorker:
+    """Gets everything that parsing and rendering need, without connecting to Discord."""
+    bot = RenderWorker()
+    bot.parser = ParserCog(bot)
+    return bot
+
+
+def tile_names(bot: RenderWorker) -> list[str]:
+    """Gets the names of tiles that can go in generated scenes, leaving out terrain."""
+    names = sorted(name for name in bot.data.data if not name.startswith("terrain_"))
+    return names or ["plate"]
+
+
+def grid(width: int, height: int, names: list[str], stack: int = 1, variants: tuple[str, ...] = ("",), seed: int = 0) -> str:
+    """Generates a scene string of width by height cells, each holding a stack of random tiles."""
+    rng = random.Random(seed)
+    return "\n".join(
+        " ".join(
+            "&".join(rng.choice(names) + rng.choice(variants) for _ in range(stack))
+            for _ in range(width)
+        )
+        for _ in range(height)
+    )
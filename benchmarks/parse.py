@@ -0,0 +1,41 @@
+"""Times ParserCog.parse, and ParserCog.parse_columns that the bot renders from, on generated scenes.
+
+Run from the root of the repository, after setup.py:
+    python -m benchmarks.parse [--repeat N]
+"""
+import argparse
+import time
+
+from benchmarks import make_bot, tile_names, grid
+from classes import ColumnarScene
+from coggers.data import FlagData
+
+SIZES = [(10, 10), (32, 32), (100, 100)]
+VARIANTS = ("", "", ":r", ":c/red", ":unit", ":disp/0/0/1")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--repeat", type=int, default=5, help="how many times to parse each scene")
+    args = arg_parser.parse_args()
+
+    bot = make_bot()
+    names = tile_names(bot)
+    for width, height in SIZES:
+        for stack in (1, 3):
+            string = grid(width, height, names, stack, VARIANTS)
+            for parse in (bot.parser.parse, bot.parser.parse_columns):
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    scene = parse(string, FlagData())
+                    times.append(time.perf_counter() - start)
+                tiles = len(scene) if isinstance(scene, ColumnarScene) else len(scene.tiles)
+                print(
+                    f"{parse.__name__:>13}, {width * height:>6} cells, stacks of {stack}: {tiles:>6} tiles, "
+                    f"best {min(times) * 1000:8.2f} ms, mean {sum(times) / len(times) * 1000:8.2f} ms"
+                )
+
+
+if __name__ == "__main__":
+    main()
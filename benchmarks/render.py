@@ -0,0 +1,142 @@
+"""Times each stage of rendering on generated scenes, reporting the results as JSON.
+
+Every case runs in a fresh process, so that the peak RSS it reports is its own.
+Run from the root of the repository, after setup.py:
+    python -m benchmarks.render [--repeat N] [--case NAME ...] [--output FILE] [--baseline FILE]
+
+Saving one run with --output and passing it to a later one as --baseline
+prints how much each stage of each case has changed since.
+"""
+import argparse
+import io
+import json
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+from benchmarks import make_bot, tile_names, grid
+from coggers.data import FlagData
+
+STAGES = ("parse", "render_scene", "render")
+
+
+def custom_text(width: int, height: int, letters: list[str], seed: int = 0) -> str:
+    """Generates a scene string of width by height custom text tiles, with random words of 1 to 6 letters."""
+    rng = random.Random(seed)
+    return "\n".join(
+        " ".join(
+            "$" + "".join(rng.choice(letters) for _ in range(rng.randint(1, 6)))
+            for _ in range(width)
+        )
+        for _ in range(height)
+    )
+
+
+# Each case gets the bot and gives back the scene string to render
+CASES = {
+    **{
+        f"grid_{size}x{size}": (lambda bot, size=size: grid(size, size, tile_names(bot)))
+        for size in (5, 10, 25, 50, 100)
+    },
+    "stack_10x10x8": lambda bot: grid(10, 10, tile_names(bot), stack=8),
+    "stack_5x5x32": lambda bot: grid(5, 5, tile_names(bot), stack=32),
+    "meta_10x10": lambda bot: grid(10, 10, tile_names(bot), variants=(":meta/16",)),
+    "variants_25x25": lambda bot: grid(25, 25, tile_names(bot), variants=("", ":c/red", ":inactive", ":gs", ":unit")),
+    "custom_text_20x20": lambda bot: custom_text(20, 20, sorted(bot.renderer.letters)),
+}
+
+
+def peak_rss() -> int:
+    """Gets the most memory this process has had resident so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, macOS in bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(name: str, repeat: int) -> dict:
+    bot = make_bot()
+    string = CASES[name](bot)
+    times = {stage: [] for stage in STAGES}
+    output_bytes = 0
+    tiles = 0
+    for _ in range(repeat):
+        flagdata = FlagData()
+        start = time.perf_counter()
+        # The columnar scene that the bot renders, which is also the only kind that gets a floor layer
+        scene = bot.parser.parse_columns(string, flagdata)
+        times["parse"].append(time.perf_counter() - start)
+        tiles = len(scene)
+
+        start = time.perf_counter()
+        bot.renderer.render_scene(scene, flagdata)
+        times["render_scene"].append(time.perf_counter() - start)
+
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        bot.renderer.render(scene, buffer, flagdata)
+        times["render"].append(time.perf_counter() - start)
+        output_bytes = buffer.tell()
+    return {
+        "case": name,
+        "tiles": tiles,
+        "stages": {
+            stage: {
+                "first": stage_times[0],
+                "best": min(stage_times),
+                "mean": sum(stage_times) / len(stage_times)
+            }
+            for stage, stage_times in times.items()
+        },
+        "peak_rss": peak_rss(),
+        "output_bytes": output_bytes
+    }
+
+
+def compare(results: list[dict], baseline: dict):
+    """Prints how the best time of each stage compares to the baseline's."""
+    baseline_cases = {result["case"]: result for result in baseline["results"]}
+    for result in results:
+        old = baseline_cases.get(result["case"])
+        if old is None:
+            continue
+        changes = []
+        for stage in STAGES:
+            before, after = old["stages"][stage]["best"], result["stages"][stage]["best"]
+            changes.append(f"{stage} {before * 1000:.1f} -> {after * 1000:.1f} ms ({after / before:.2f}x)")
+        changes.append(f"rss {old['peak_rss'] / 2 ** 20:.0f} -> {result['peak_rss'] / 2 ** 20:.0f} MiB")
+        changes.append(f"bytes {old['output_bytes']} -> {result['output_bytes']}")
+        print(f"{result['case']}: " + ", ".join(changes), file=sys.stderr)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--repeat", type=int, default=3, help="how many times to run each case")
+    arg_parser.add_argument("--case", action="append", choices=CASES, help="only run these cases")
+    arg_parser.add_argument("--output", help="a file to save the results to, as well as printing them")
+    arg_parser.add_argument("--baseline", help="results from an earlier run to compare against")
+    args = arg_parser.parse_args()
+
+    results = []
+    for name in args.case or CASES:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results.append(pool.submit(run_case, name, args.repeat).result())
+    report = {
+        "engine": config.render_engine,
+        "repeat": args.repeat,
+        "results": results
+    }
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
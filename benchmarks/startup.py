@@ -0,0 +1,94 @@
+"""Times how long the bot takes to start up, reporting the results as JSON.
+
+Importing the cogs is timed with -X importtime in a fresh interpreter, reporting the modules that take the longest
+including what they import. Setting up what rendering needs, warming up and the first render are timed in a fresh process too.
+Run from the root of the repository, after setup.py:
+    python -m benchmarks.startup [--top N] [--output FILE]
+"""
+import argparse
+import io
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+from benchmarks import tile_names, grid
+from coggers.data import DataCog, FlagData
+from coggers.executor import RenderWorker
+from coggers.parser import ParserCog
+from coggers.render import RenderCog
+from coggers.variants import VariantCog
+
+
+def import_times(top: int) -> dict:
+    """Imports every cog in a fresh interpreter, getting the total and the slowest modules in milliseconds."""
+    code = "; ".join(f"import {cog}" for cog in config.cogs)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        # Each line looks like "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # Modules are indented under whatever imported them, after the one space that every line has
+        modules.append((name[1:].rstrip(), int(cumulative) / 1000))
+    # Top-level modules add up to the whole import without counting anything twice
+    total = sum(cumulative for name, cumulative in modules if not name.startswith(" "))
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return {
+        "total": total,
+        "modules": [{"module": name.strip(), "cumulative": cumulative} for name, cumulative in modules[:top]]
+    }
+
+
+def setup_times() -> dict:
+    """Sets up what rendering needs like a render worker does, getting how long each part takes in milliseconds."""
+    times = {}
+    bot = RenderWorker.__new__(RenderWorker)
+    start = time.perf_counter()
+    bot.data = DataCog(bot)
+    bot.data.load_tile_data()
+    times["data"] = time.perf_counter() - start
+    start = time.perf_counter()
+    bot.variant_handler = VariantCog(bot)
+    times["variants"] = time.perf_counter() - start
+    start = time.perf_counter()
+    bot.renderer = RenderCog(bot)
+    times["renderer"] = time.perf_counter() - start
+    bot.parser = ParserCog(bot)
+
+    names = tile_names(bot)
+    string = grid(10, 10, names)
+    start = time.perf_counter()
+    bot.warm(names[:config.warmup_sprites])
+    times["warmup"] = time.perf_counter() - start
+    start = time.perf_counter()
+    bot.renderer.render(bot.parser.parse(string, FlagData()), io.BytesIO(), FlagData())
+    times["first_render"] = time.perf_counter() - start
+    return {stage: seconds * 1000 for stage, seconds in times.items()}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--top", type=int, default=15, help="how many of the slowest modules to report")
+    arg_parser.add_argument("--output", help="a file to save the results to, as well as printing them")
+    args = arg_parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        setup = pool.submit(setup_times).result()
+    report = {
+        "imports": import_times(args.top),
+        "setup": setup,
+        "warmup_sprites": config.warmup_sprites
+    }
+    text = json.dumps(report, indent=4)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
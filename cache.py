@@ -0,0 +1,206 @@
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Callable, Hashable, Iterator
+
+import numpy as np
+
+# Read once up front, since reading it means setting it for the whole process for a moment
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+@contextmanager
+def replacing(path: Path, mode: str = "wb") -> Iterator[IO]:
+    """Opens a file of its own next to a path for the body of a with statement, and then moves it over the path.
+
+    Other processes only ever see the old file or all of the new one, and ones that have the old one open or mapped keep it.
+    If the body fails, the new file's removed and the path's left alone."""
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        # mkstemp makes files only their owner can read, where they'd otherwise get what the umask allows
+        os.chmod(temp, 0o666 & ~UMASK)
+        os.replace(temp, path)
+    except BaseException:
+        Path(temp).unlink(missing_ok=True)
+        raise
+
+
+class LRUCache:
+    """A dictionary that forgets its least recently used entries once it goes over its budget."""
+
+    def __init__(self, budget: int, sizeof: Callable[[object], int] = lambda value: 1):
+        """The budget is in whatever unit sizeof measures. By default, that's the amount of entries."""
+        self.budget = budget
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[Hashable, tuple[object, int]] = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self.entries
+
+    def get(self, key: Hashable, default=None):
+        """Gets an entry, marking it as recently used."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key: Hashable, value):
+        size = self.sizeof(value)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.budget:
+            # This would push everything else out and then not fit anyway
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class DiskCache:
+    """Keeps bytes in files under a directory, deleting the least recently used ones once they go over their budget.
+
+    Keys are used as file names, so they should be hex digests or similar."""
+
+    def __init__(self, directory: Path, budget: int):
+        """The budget is in bytes. Files already in the directory are kept, oldest first in line to be deleted."""
+        self.directory = directory
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in sorted(directory.iterdir(), key=lambda path: path.stat().st_mtime):
+            if path.is_file() and not path.name.endswith(".tmp"):
+                self.entries[path.name] = path.stat().st_size
+                self.size += self.entries[path.name]
+        self.evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def get(self, key: str, default=None) -> bytes | None:
+        """Reads an entry, marking it as recently used."""
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        path = self.directory / key
+        try:
+            value = path.read_bytes()
+            # Keeps the order right for the next time the directory's loaded
+            os.utime(path)
+        except FileNotFoundError:
+            # Deleted from under us
+            self.size -= self.entries.pop(key)
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: str, value: bytes):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)
+        if len(value) > self.budget:
+            # Otherwise the old file would stay on disk without being counted
+            (self.directory / key).unlink(missing_ok=True)
+            return
+        # Written to the side and then moved, so a half written file is never read
+        temp = self.directory / (key + ".tmp")
+        temp.write_bytes(value)
+        os.replace(temp, self.directory / key)
+        self.entries[key] = len(value)
+        self.size += len(value)
+        self.evict()
+
+    def evict(self):
+        while self.size > self.budget:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            (self.directory / key).unlink(missing_ok=True)
+
+    def clear(self):
+        for key in self.entries:
+            (self.directory / key).unlink(missing_ok=True)
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class TieredCache:
+    """An LRU cache in memory in front of an optional one on disk. Entries read from disk move up into memory."""
+
+    def __init__(self, memory: LRUCache, disk: DiskCache | None = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str, default=None) -> bytes | None:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory[key] = value
+        return default if value is None else value
+
+    def __setitem__(self, key: str, value: bytes):
+        self.memory[key] = value
+        if self.disk is not None:
+            self.disk[key] = value
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+def image_size(image) -> int:
+    """Gets roughly how many bytes a PIL image or array takes up in memory."""
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
@@ -1,10 +1,18 @@
+import hashlib
 import math
+from array import array
+from collections import Counter
+from typing import Iterable, Iterator
 
+import numpy as np
 from PIL.Image import Image
 from attr import define
 
 from coggers.data import TileData
 
+# A tile as (name, x, y, z, p, direction, variants, data)
+TileRow = tuple[str, float, float, float, float, int, list["Variant"], TileData]
+
 
 @define
 class Variant:
@@ -57,6 +65,9 @@ class Tile:
     """The tile's direction. Goes from 0 to 3."""
     direction: int = 0
 
+    """Whether the tile is the scene's ground under a cell, rather than a tile or a terrain override."""
+    floor: bool = False
+
     def __lt__(self, other):
         """Returns whether this tile should be drawn under the other tile."""
         if (self.y - self.x) != (other.y - other.x):
@@ -88,5 +99,212 @@ class Scene:
     """A sparse tile grid."""
     tiles: list[Tile]
 
+    def rows(self) -> Iterator[TileRow]:
+        """Iterates over the tiles as plain tuples, in drawing order."""
+        for tile in self.tiles:
+            yield tile.name, tile.x, tile.y, tile.z, tile.p, tile.direction, tile.variants, tile.data
+
+
+@define
+class SceneBounds:
+    """Keeps track of how far a scene reaches as its tiles are added."""
+
+    """The width of the scene."""
+    width: float = 0.0
+
+    """The height of the scene."""
+    height: float = 0.0
+
+    """The minimum depth of the scene."""
+    min_depth: float = 0.0
+
+    """The maximum depth of the scene."""
+    max_depth: float = 0.0
+
+    """The pixel depth of the scene."""
+    pixel_depth: float = 0.0
+
+    def include(self, x: float, y: float, z: float, p: float):
+        """Grows the bounds to fit a position."""
+        if x > self.width:
+            self.width = x
+        if y > self.height:
+            self.height = y
+        if z > self.max_depth:
+            self.max_depth = z
+        if z < self.min_depth:
+            self.min_depth = z
+        if p > self.pixel_depth:
+            self.pixel_depth = p
+
+
+@define
+class ColumnarScene:
+    """A render scene that stores its tiles as columns, instead of as an object per tile."""
+
+    """The width of the scene."""
+    width: float
+
+    """The height of the scene."""
+    height: float
+
+    """The minimum depth of the scene."""
+    min_depth: float
+
+    """The maximum depth of the scene."""
+    max_depth: float
+
+    """The pixel depth of the scene."""
+    pixel_depth: float
+
+    """Each tile's X, Y, Z and pixel layer, as float columns."""
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+    p: np.ndarray
+
+    """Each tile's direction."""
+    direction: np.ndarray
+
+    """Each tile's index into kinds."""
+    kind: np.ndarray
+
+    """Each tile's index into chains."""
+    chain: np.ndarray
+
+    """Whether each tile is the scene's ground under a cell."""
+    floor: np.ndarray
+
+    """Every distinct (name, data) of the scene's tiles."""
+    kinds: list[tuple[str, TileData]]
+
+    """Every distinct variant list of the scene's tiles."""
+    chains: list[list[Variant]]
+
+    @classmethod
+    def from_tiles(cls, tiles: Iterable[Tile], bounds: SceneBounds):
+        """Packs tiles into columns as they come, sorting them into drawing order at the end.
+
+        The bounds are read once all the tiles are in, so they can be filled in by the iterable."""
+        columns = {name: array("d") for name in ("x", "y", "z", "p")}
+        direction = array("B")
+        kind = array("l")
+        chain = array("l")
+        floor = array("B")
+        kinds = {}
+        chains = {}
+        for tile in tiles:
+            columns["x"].append(tile.x)
+            columns["y"].append(tile.y)
+            columns["z"].append(tile.z)
+            columns["p"].append(tile.p)
+            direction.append(tile.direction)
+            floor.append(tile.floor)
+            data = tile.data
+            kind_key = (tile.name, data.directional, data.ground_height, data.frames, data.unit, data.directory)
+            kind.append(kinds.setdefault(kind_key, (len(kinds), (tile.name, data)))[0])
+            chain_key = tuple((variant.name, tuple(variant.arguments)) for variant in tile.variants)
+            chain.append(chains.setdefault(chain_key, (len(chains), tile.variants))[0])
+        x, y, z, p = (np.frombuffer(columns[name], dtype=np.float64) for name in ("x", "y", "z", "p"))
+        # Same order as Tile.__lt__, and stable like list.sort
+        order = np.lexsort((p, z, y - x))
+        return cls(
+            bounds.width, bounds.height, bounds.min_depth, bounds.max_depth, bounds.pixel_depth,
+            x[order], y[order], z[order], p[order],
+            np.frombuffer(direction, dtype=np.uint8)[order],
+            np.frombuffer(kind, dtype=np.int_)[order],
+            np.frombuffer(chain, dtype=np.int_)[order],
+            np.frombuffer(floor, dtype=np.bool_)[order],
+            [value for _, value in kinds.values()],
+            [value for _, value in chains.values()]
+        )
+
+    @classmethod
+    def from_scene(cls, scene: Scene):
+        bounds = SceneBounds(scene.width, scene.height, scene.min_depth, scene.max_depth, scene.pixel_depth)
+        return cls.from_tiles(scene.tiles, bounds)
+
+    def __len__(self):
+        return len(self.x)
+
+    def bounds(self) -> tuple[float, float, float, float, float]:
+        return self.width, self.height, self.min_depth, self.max_depth, self.pixel_depth
+
+    def kind_keys(self) -> list[str]:
+        """Gets a string for each kind that's the same for equal kinds across scenes."""
+        return [
+            repr((name, data.directional, data.ground_height, data.frames, data.unit, data.directory))
+            for name, data in self.kinds
+        ]
+
+    def chain_keys(self) -> list[str]:
+        """Gets a string for each chain that's the same for equal chains across scenes."""
+        return [repr([(variant.name, variant.arguments) for variant in chain]) for chain in self.chains]
+
+    def tile_keys(self) -> list[tuple]:
+        """Gets a tuple for each tile, in drawing order, that's the same for equal tiles across scenes."""
+        kind_keys = self.kind_keys()
+        chain_keys = self.chain_keys()
+        return [
+            (kind_keys[kind], x, y, z, p, direction, chain_keys[chain])
+            for x, y, z, p, direction, kind, chain in zip(
+                self.x.tolist(), self.y.tolist(), self.z.tolist(), self.p.tolist(),
+                self.direction.tolist(), self.kind.tolist(), self.chain.tolist()
+            )
+        ]
+
+    def take(self, mask: np.ndarray) -> "ColumnarScene":
+        """Gets the tiles picked out by a mask or indices as a scene of their own, keeping the bounds of this one."""
+        return ColumnarScene(
+            *self.bounds(),
+            self.x[mask], self.y[mask], self.z[mask], self.p[mask],
+            self.direction[mask], self.kind[mask], self.chain[mask], self.floor[mask],
+            self.kinds, self.chains
+        )
+
+    def changes(self, other: "ColumnarScene") -> tuple[np.ndarray, np.ndarray]:
+        """Compares this scene's tiles against another's, as masks of the tiles only in other and only in this one."""
+        own_keys = self.tile_keys()
+        other_keys = other.tile_keys()
+        return missing_from(other_keys, own_keys), missing_from(own_keys, other_keys)
+
+    def rows(self) -> Iterator[TileRow]:
+        """Iterates over the tiles as plain tuples, in drawing order."""
+        for x, y, z, p, direction, kind, chain in zip(
+            self.x.tolist(), self.y.tolist(), self.z.tolist(), self.p.tolist(),
+            self.direction.tolist(), self.kind.tolist(), self.chain.tolist()
+        ):
+            name, data = self.kinds[kind]
+            yield name, x, y, z, p, direction, self.chains[chain], data
+
+    def digest(self) -> bytes:
+        """Hashes everything about the scene that changes how it renders.
+
+        Kinds and chains are hashed by what they are rather than by their IDs,
+        so scenes that only differ in which tile was written first still hash the same."""
+        hasher = hashlib.sha256()
+        hasher.update(np.array(self.bounds(), dtype=np.float64).tobytes())
+        for column in (self.x, self.y, self.z, self.p, self.direction):
+            hasher.update(column.tobytes())
+        for ids, keys in ((self.kind, self.kind_keys()), (self.chain, self.chain_keys())):
+            rank = np.empty(len(keys), dtype=np.int64)
+            rank[sorted(range(len(keys)), key=keys.__getitem__)] = np.arange(len(keys))
+            hasher.update(rank[ids].tobytes())
+            hasher.update(repr(sorted(keys)).encode())
+        return hasher.digest()
+
+
+def missing_from(keys: list[tuple], others: list[tuple]) -> np.ndarray:
+    """Masks out which keys aren't in others, counting duplicates separately."""
+    remaining = Counter(others)
+    missing = np.zeros(len(keys), dtype=bool)
+    for i, key in enumerate(keys):
+        if remaining[key] > 0:
+            remaining[key] -= 1
+        else:
+            missing[i] = True
+    return missing
+
+
 class CustomError(Exception):
     pass
\ No newline at end of file
@@ -1,9 +1,16 @@
+import asyncio
+import hashlib
 import json
 from pathlib import Path
+from typing import Iterator, Mapping
+
+import numpy as np
 
 from discord.ext import commands
 from attrs import define
 
+from cache import replacing
+
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -42,33 +49,166 @@ class FlagData:
     """The color of the background."""
     background: tuple[int, int, int, int] = (0x40, 0x44, 0x64, 0xFF)
 
+    """The file format to save the render as."""
+    format: str = "gif"
+
+    """The palette that color variants pick from."""
+    palette: str = "default"
+
+    """The tile under every cell that doesn't override its terrain."""
+    ground: str = "terrain_0"
+
+
+# Bumped whenever the index's layout changes, so that old ones get rebuilt
+INDEX_VERSION = 1
+INDEX_PATH = Path("data", "tiles.index.npy")
+INDEX_HEADER_PATH = Path("data", "tiles.index.json")
+
+
+def index_dtype(name_length: int) -> np.dtype:
+    """Gets the type of the index's rows, with room for names up to a length."""
+    return np.dtype([
+        ("name", f"U{max(name_length, 1)}"),
+        ("pack", "u1"),
+        ("directional", "?"),
+        ("ground_height", "i2"),
+        ("frames", "u1"),
+        ("unit", "?")
+    ])
+
+
+class TileIndex(Mapping[str, TileData]):
+    """The tile data of every pack as one table, handing out TileData for tiles as they're asked for.
+
+    Each tile gets one TileData, which is shared by everything that asks for it."""
+
+    def __init__(self, table: np.ndarray, packs: list[str]):
+        """Each row's pack is an index into the list of packs."""
+        self.table = table
+        self.packs = packs
+        # Later rows win, like later packs used to overwrite earlier ones
+        self.rows = {name: i for i, name in enumerate(table["name"].tolist())}
+        self.loaded: dict[str, TileData] = {}
+
+    def __getitem__(self, name: str) -> TileData:
+        data = self.loaded.get(name)
+        if data is None:
+            row = self.table[self.rows[name]]
+            data = TileData(
+                bool(row["directional"]),
+                int(row["ground_height"]),
+                int(row["frames"]),
+                bool(row["unit"]),
+                self.packs[row["pack"]]
+            )
+            self.loaded[name] = data
+        return data
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
 
 class DataCog(commands.Cog):
     """Cog for handling loading data."""
 
     """The cached data for the tiles."""
-    data: dict[str, TileData]
-
-    """Loads tile data for all tiles."""
-
-    def load_tile_data(self):
-        self.data = {}
-        for path in Path("data").glob("*/"):
-            if path.name != "special":
-                with open(path / "tiles.json") as t:
-                    obj: dict[str, dict] = json.load(t)
-                for (name, tile) in obj.items():
-                    tile_data = TileData(
-                        tile["dir"],
-                        tile["ground"],
-                        tile["frames"],
-                        tile["unit"],
-                        path.name
-                    )
-                    self.data[name] = tile_data
+    data: TileIndex
+
+    """The modification time of each pack's tiles.json that the data was loaded from, by pack."""
+    pack_times: dict[str, int]
+
+    """A hash of the path, size and modification time of every data file, which changes whenever any of them do."""
+    version: str
+
+    """Loads tile data for all tiles, only reading the packs that changed since the index was built."""
+
+    def load_tile_data(self) -> tuple[list[str], list[str]]:
+        """Returns the packs that had to be read, and the packs that were removed since the index was built."""
+        self.version = self.hash_data()
+        # Palettes and the like are kept alongside the tile packs
+        pack_times = {
+            path.parent.name: path.stat().st_mtime_ns
+            for path in sorted(Path("data").glob("*/tiles.json"))
+        }
+        table, packs, index_times = self.read_index()
+        removed = sorted(set(index_times) - set(pack_times))
+        if index_times == pack_times:
+            self.data = TileIndex(table, packs)
+            self.pack_times = pack_times
+            return [], []
+
+        changed = []
+        # Each pack's rows, or None for packs whose rows are kept from the old index
+        pack_rows = []
+        for pack, mtime in pack_times.items():
+            if index_times.get(pack) == mtime:
+                pack_rows.append(None)
+                continue
+            changed.append(pack)
+            with open(Path("data", pack, "tiles.json")) as t:
+                obj: dict[str, dict] = json.load(t)
+            pack_rows.append([
+                (name, len(pack_rows), tile["dir"], tile["ground"], tile["frames"], tile["unit"])
+                for name, tile in obj.items()
+            ])
+        # Names are stored at a fixed length, so it has to fit the longest of them
+        name_length = max((len(row[0]) for rows in pack_rows if rows is not None for row in rows), default=0)
+        if any(rows is None for rows in pack_rows):
+            name_length = max(name_length, table.dtype["name"].itemsize // 4)
+        dtype = index_dtype(name_length)
+        tables = []
+        for i, (pack, rows) in enumerate(zip(pack_times, pack_rows)):
+            if rows is None:
+                old_rows = table[table["pack"] == packs.index(pack)].astype(dtype)
+                old_rows["pack"] = i
+                tables.append(old_rows)
+            else:
+                tables.append(np.array(rows, dtype=dtype))
+        table = np.concatenate(tables) if len(tables) else np.zeros(0, dtype=dtype)
+        self.write_index(table, pack_times)
+        self.data = TileIndex(table, list(pack_times))
+        self.pack_times = pack_times
+        return changed, removed
+
+    def read_index(self) -> tuple[np.ndarray, list[str], dict[str, int]]:
+        """Maps the index from disk, returning its table, its packs and the modification times they were read at.
+        Without a usable index, that's all empty."""
+        try:
+            with open(INDEX_HEADER_PATH) as f:
+                header = json.load(f)
+            if header["version"] != INDEX_VERSION:
+                raise ValueError("Outdated index")
+            table = np.load(INDEX_PATH, mmap_mode="r")
+        except (FileNotFoundError, ValueError, KeyError):
+            return np.zeros(0, dtype=index_dtype(0)), [], {}
+        return table, list(header["packs"]), header["packs"]
+
+    def write_index(self, table: np.ndarray, pack_times: dict[str, int]):
+        # Written to the side and then moved, so that other processes never read half of one.
+        # Every worker can be rebuilding it at once, so each writes to its own file, named so that hash_data skips it.
+        with replacing(INDEX_PATH) as f:
+            np.save(f, table)
+        with replacing(INDEX_HEADER_PATH, "w") as f:
+            json.dump({"version": INDEX_VERSION, "packs": pack_times}, f)
+
+    def hash_data(self) -> str:
+        hasher = hashlib.sha256()
+        for path in sorted(Path("data").rglob("*")):
+            # The index is made from the rest, so it doesn't need to be counted
+            if path.is_file() and not path.name.startswith("tiles.index"):
+                stat = path.stat()
+                hasher.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        return hasher.hexdigest()
 
 
 async def setup(bot: Bot):
     cog = DataCog(bot)
-    cog.load_tile_data()
+    # Off of the event loop, so the gateway doesn't stall if a lot of packs need reading
+    await asyncio.to_thread(cog.load_tile_data)
     bot.data = cog
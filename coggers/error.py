@@ -1,13 +1,8 @@
 import os
 import traceback
 
-from PIL import Image
-import numpy as np
-from json import load
-from datetime import datetime
 import discord
 from discord.ext import commands
-from io import BytesIO
 
 from classes import CustomError
 
@@ -0,0 +1,314 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+from attrs import define, astuple
+from discord.ext import commands
+
+from typing import TYPE_CHECKING
+
+import config
+import tracing
+from cache import LRUCache, DiskCache, TieredCache
+from classes import Scene, ColumnarScene, CustomError
+from compositor import COMPOSITORS
+from coggers.data import DataCog, FlagData
+from coggers.render import RenderCog
+from coggers.variants import VariantCog
+from scheduler import Scheduler, Ticket
+
+if TYPE_CHECKING:
+    from ROBOT import Bot
+else:
+    class Bot:
+        pass
+
+
+@define
+class RenderJob:
+    """Everything a render worker needs to render a scene."""
+
+    """The scene, packed into columns so that it pickles small."""
+    scene: ColumnarScene
+
+    """The flag data's fields, in order."""
+    flags: tuple
+
+    """The time.time() after which the job isn't worth starting anymore."""
+    deadline: float
+
+    """An earlier render's scene and frames, which only the changes since get drawn over."""
+    previous: tuple[ColumnarScene, list[np.ndarray]] | None = None
+
+    """Whether the frames should be sent back along with the file."""
+    keep_frames: bool = False
+
+    """The version of the data files that the bot had loaded, which the worker catches up to before rendering."""
+    data_version: str = ""
+
+    @classmethod
+    def pack(cls, scene: Scene | ColumnarScene, flagdata: FlagData, deadline: float, **kwargs):
+        if isinstance(scene, Scene):
+            scene = ColumnarScene.from_scene(scene)
+        return cls(scene, astuple(flagdata), deadline, **kwargs)
+
+    def unpack(self) -> tuple[ColumnarScene, FlagData]:
+        return self.scene, FlagData(*self.flags)
+
+
+class RenderWorker:
+    """Stands in for the bot inside of a render worker, holding only what rendering needs."""
+
+    def __init__(self):
+        self.data = DataCog(self)
+        self.data.load_tile_data()
+        self.variant_handler = VariantCog(self)
+        self.renderer = RenderCog(self)
+        # The bot's version to compare with, which can lag behind the files until it reloads too
+        self.synced_version = self.data.version
+
+    def reload(self):
+        """Catches up to changed data files, throwing out everything that was cached from the old ones."""
+        self.data.load_tile_data()
+        self.variant_handler = VariantCog(self)
+        self.renderer = RenderCog(self)
+
+    def render(self, job: RenderJob) -> tuple[bytes, dict[str, float], list[np.ndarray] | None]:
+        """Renders a job, returning the encoded file, how long each stage of rendering took, and the frames if they were asked for."""
+        if time.time() > job.deadline:
+            raise CustomError("The render took too long to start, try again in a bit.")
+        with tracing.collect() as trace:
+            if job.data_version and job.data_version != self.synced_version:
+                with trace.span("reload"):
+                    self.reload()
+                self.synced_version = job.data_version
+            start = time.perf_counter()
+            scene, flagdata = job.unpack()
+            buf = io.BytesIO()
+            frames = self.renderer.render(scene, buf, flagdata, job.previous)
+            trace.add("worker", time.perf_counter() - start)
+        return buf.getvalue(), trace.stages, frames if job.keep_frames else None
+
+    def warm(self, names: list[str]) -> int:
+        """Decodes and prepares the sprites of some tiles ahead of time, returning how many sprites that was."""
+        # Only for its prepared sprite cache, so the size doesn't matter
+        compositor = COMPOSITORS[config.render_engine](1, 1, (0, 0, 0, 0), self.renderer.prepared_cache)
+        keys = set()
+        for name in names:
+            data = self.data.data.get(name)
+            if data is None:
+                continue
+            for direction in range(4):
+                for wobble in range(3):
+                    key = self.renderer.sprite_key(name, data, direction, wobble)
+                    if key in keys:
+                        continue
+                    keys.add(key)
+                    try:
+                        sprite = self.renderer.get_sprite(key)
+                    except CustomError:
+                        # Missing files only matter once something's rendered with them
+                        continue
+                    if sprite is None:
+                        continue
+                    compositor.prepare(sprite, data.unit)
+        return len(keys)
+
+
+# One per worker process
+worker: RenderWorker | None = None
+
+
+def init_worker():
+    global worker
+    worker = RenderWorker()
+
+
+def run_job(job: RenderJob) -> tuple[bytes, dict[str, float], list[np.ndarray] | None]:
+    return worker.render(job)
+
+
+def warm_job(names: list[str]) -> int:
+    return worker.warm(names)
+
+
+class RenderExecutorCog(commands.Cog):
+    """Cog for running renders away from the event loop."""
+
+    """The pool that renders are sent to."""
+    pool: Executor
+
+    """The amount of renders that are queued or running."""
+    pending: int
+
+    """Finished renders, keyed by result_key."""
+    results: TieredCache
+
+    """Decides when each render command gets to send its render to the pool."""
+    scheduler: Scheduler
+
+    """How many times each tile has been sent to be rendered, kept between restarts in config.usage_file."""
+    usage: Counter[str]
+
+    """Whether the workers have been warmed up yet."""
+    warmed: bool
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.pending = 0
+        self.pool = self.make_pool()
+        disk = None
+        if config.result_cache_dir is not None:
+            disk = DiskCache(Path(config.result_cache_dir), config.result_cache_disk_size)
+        self.results = TieredCache(LRUCache(config.result_cache_size, len), disk)
+        self.scheduler = Scheduler(
+            config.render_capacity, config.render_cost_limit, config.render_user_limit, config.render_guild_weights
+        )
+        self.usage = Counter()
+        if config.usage_file is not None and Path(config.usage_file).exists():
+            with open(config.usage_file) as f:
+                self.usage.update(json.load(f))
+        self.warmed = False
+        self.warming: asyncio.Task | None = None
+
+    def make_pool(self) -> Executor:
+        if config.render_workers == 0:
+            return ThreadPoolExecutor(max_workers=1, initializer=init_worker)
+        # Forking would clone the whole running bot, its connection and threads included, into every worker
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(
+            max_workers=config.render_workers, initializer=init_worker, mp_context=multiprocessing.get_context(method)
+        )
+
+    def replace_pool(self, pool: Executor):
+        """Throws out a pool that a worker died in, since none of it can be trusted anymore, unless it's been already."""
+        if self.pool is not pool:
+            return
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.make_pool()
+
+    async def cog_unload(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.save_usage()
+
+    def save_usage(self):
+        if config.usage_file is None:
+            return
+        temp = Path(config.usage_file).with_suffix(".tmp")
+        with open(temp, "w") as f:
+            json.dump(dict(self.usage.most_common()), f)
+        temp.replace(config.usage_file)
+
+    async def warmup(self):
+        """Has every worker start up, and decode and prepare the sprites of the most rendered tiles, before renders come in.
+
+        The pool hands jobs to whichever worker is free, so this sends one per worker and counts on them spreading out."""
+        if self.warmed or not config.warmup_sprites:
+            return
+        self.warmed = True
+        start = time.perf_counter()
+        names = [name for name, _ in self.usage.most_common(config.warmup_sprites)]
+        futures = [self.pool.submit(warm_job, names) for _ in range(max(config.render_workers, 1))]
+        counts = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        print(f"Warmed up {max(counts)} sprites of {len(names)} tiles in {time.perf_counter() - start:.2f}s")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.warmup()
+
+    def result_key(self, scene: ColumnarScene, flagdata: FlagData) -> str:
+        """Gets the key a render is cached under, which changes with the scene, the flags or the data files."""
+        hasher = hashlib.sha256(scene.digest())
+        hasher.update(repr(astuple(flagdata)).encode())
+        hasher.update(self.bot.data.version.encode())
+        return hasher.hexdigest()
+
+    def cached(self, scene: ColumnarScene, flagdata: FlagData) -> tuple[str, bytes | None]:
+        """Gets the key a scene's render is cached under, and the finished render if it's been rendered before.
+
+        Passing the key on to render saves it looking again."""
+        with tracing.span("cache"):
+            key = self.result_key(scene, flagdata)
+            return key, self.results.get(key)
+
+    async def render(
+            self, scene: Scene | ColumnarScene, flagdata: FlagData,
+            previous: tuple[ColumnarScene, list[np.ndarray]] | None = None, keep_frames: bool = False,
+            ticket: Ticket | None = None, key: str | None = None
+    ) -> tuple[bytes, list[np.ndarray] | None]:
+        """Renders a scene in the pool, returning the encoded file and its frames if they're asked for.
+
+        Scenes that have been rendered before come from the cache, without their frames.
+        Passing the scene and frames of an earlier render only redraws what changed since.
+        Passing the key from cached skips the cache, since it's already been checked.
+        A render that times out after a worker started it keeps counting, and keeps the scheduler ticket's place,
+        until the worker's done with it."""
+        trace = tracing.current()
+        with trace.span("pack"):
+            job = RenderJob.pack(
+                scene, flagdata, time.time() + config.render_timeout, previous=previous, keep_frames=keep_frames,
+                data_version=self.bot.data.version
+            )
+            counts = np.bincount(job.scene.kind, minlength=len(job.scene.kinds)).tolist()
+            for (name, _), count in zip(job.scene.kinds, counts):
+                self.usage[name] += count
+        if key is None:
+            key, result = self.cached(job.scene, flagdata)
+            if result is not None:
+                return result, None
+        if self.pending >= config.render_queue_limit:
+            raise CustomError("There's too many renders queued right now, try again in a bit.")
+        self.pending += 1
+        start = time.perf_counter()
+        wrapped = None
+        pool = self.pool
+        try:
+            try:
+                future = pool.submit(run_job, job)
+                wrapped = asyncio.wrap_future(future)
+                # Shielded, so that timing out doesn't stop waiting on the worker
+                result, stages, frames = await asyncio.wait_for(asyncio.shield(wrapped), timeout=config.render_timeout)
+                trace.merge(stages)
+                # Whatever the worker didn't spend rendering went to waiting in the queue and sending the job back and forth
+                trace.add("queue", time.perf_counter() - start - stages["worker"])
+                with trace.span("cache"):
+                    self.results[key] = result
+                return result, frames
+            except asyncio.TimeoutError:
+                future.cancel()
+                raise CustomError(f"The render took longer than {config.render_timeout} seconds!")
+            except BrokenProcessPool:
+                self.replace_pool(pool)
+                raise CustomError("The renderer crashed, try again.")
+        finally:
+            if wrapped is None or wrapped.done():
+                self.pending -= 1
+            else:
+                # Workers can't be stopped partway through a job, so it counts until it's done
+                wrapped.add_done_callback(lambda done: self.finish_job(pool, done))
+                if ticket is not None:
+                    ticket.held = wrapped
+
+    def finish_job(self, pool: Executor, future: asyncio.Future):
+        """Stops counting a job that was given up on once its worker's done with it."""
+        self.pending -= 1
+        # Nothing's waiting on it anymore, so it'd be logged as never retrieved otherwise
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self.replace_pool(pool)
+
+
+async def setup(bot: Bot):
+    cog = RenderExecutorCog(bot)
+    await bot.add_cog(cog)
+    bot.executor = cog
+    # Reloading happens after the bot's ready, so it won't be told again
+    if bot.is_ready():
+        cog.warming = asyncio.create_task(cog.warmup())
@@ -1,13 +1,11 @@
 from typing import TYPE_CHECKING
 
-from PIL import Image
-import numpy as np
-from json import load
-from datetime import datetime
-import discord
-from discord.ext import commands
-from io import BytesIO
 import asyncio
+import time
+
+from discord.ext import commands
+
+import tracing
 
 if TYPE_CHECKING:
     from ROBOT import Bot
@@ -23,12 +21,58 @@ class OwnerCog(commands.Cog):
     @commands.is_owner()
     @commands.command(aliases=["rr"])
     async def reload(self, ctx):
+        # This also restarts the render workers, which throws out their sprite caches and reloads the atlas,
+        # which reads any sprite whose file changed since it was built from that file instead.
         await asyncio.gather(*((
             self.bot.reload_extension(extension))
             for extension in self.bot.extensions.keys()
         ))
         await ctx.send("Reloaded all extensions.")
 
+    @commands.is_owner()
+    @commands.command(aliases=["rd"])
+    async def reloaddata(self, ctx):
+        """Reloads the tile data, only reading the packs that changed and dropping removed ones. Render workers catch up on their next render."""
+        start = time.perf_counter()
+        changed, removed = await asyncio.to_thread(self.bot.data.load_tile_data)
+        took = time.perf_counter() - start
+        if not (len(changed) or len(removed)):
+            return await ctx.send(f"No packs changed. ({took * 1000:.0f}ms)")
+        parts = []
+        if len(changed):
+            parts.append(f"Reloaded {', '.join(changed)}.")
+        if len(removed):
+            parts.append(f"Removed {', '.join(removed)}.")
+        await ctx.send(f"{' '.join(parts)} ({took * 1000:.0f}ms)")
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx, reset: str = ""):
+        """Shows the p50/p95/p99 time of each stage of traced commands. `stats reset` clears them."""
+        if reset == "reset":
+            tracing.recorder.clear()
+            return await ctx.send("Cleared the stats.")
+        percentiles = tracing.recorder.percentiles()
+        if not len(percentiles):
+            return await ctx.send("Nothing's been traced yet.")
+        width = max(len(stage) for stage in percentiles)
+        lines = [f"{'stage':<{width}} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}"]
+        for stage, (count, p50, p95, p99) in percentiles.items():
+            lines.append(f"{stage:<{width}} {count:>6} {p50 * 1000:>7.1f}ms {p95 * 1000:>7.1f}ms {p99 * 1000:>7.1f}ms")
+        for tier, stats in self.bot.executor.results.stats().items():
+            lookups = stats["hits"] + stats["misses"]
+            lines.append(
+                f"result cache ({tier}): {stats['entries']} renders, {stats['size'] / 2 ** 20:.1f}/{stats['budget'] / 2 ** 20:.0f} MiB, "
+                f"{stats['hits']}/{lookups} hits"
+            )
+        stats = self.bot.executor.scheduler.stats()
+        lines.append(
+            f"scheduler: {stats['queued']} waiting, {stats['running']} running "
+            f"({stats['running_cost']:.1f}/{stats['capacity']:.0f}s estimated), "
+            f"{stats['admitted']} let through, {stats['rejected']} turned away"
+        )
+        await ctx.send(f"Over {tracing.recorder.traces} commands:\n```\n" + "\n".join(lines) + "\n```")
+
 
 async def setup(bot: Bot):
     await bot.add_cog(OwnerCog(bot))
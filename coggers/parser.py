@@ -1,14 +1,12 @@
-import json
-import math
 import re
-from functools import total_ordering
+from typing import Iterator
 
 from discord.ext import commands
-from attrs import define
 
 from typing import TYPE_CHECKING
-from classes import Tile, Scene, Variant, CustomError
+from classes import Tile, Scene, ColumnarScene, SceneBounds, Variant, CustomError
 from coggers.data import TileData, FlagData
+from encoder import FORMATS
 
 if TYPE_CHECKING:
     from ROBOT import Bot
@@ -16,6 +14,11 @@ else:
     class Bot:
         pass
 
+FLAG_PATTERN = re.compile(r"\s*--([^=\s]+)(?:=(\S+))?\s*")
+ESCAPE_PATTERN = re.compile(r"\\(.)")
+
+CUSTOM_TEXT_DATA = TileData(directional=False, ground_height=0, frames=1, unit=True, directory="custom_text_")
+
 
 # noinspection PyMethodMayBeStatic
 class ParserCog(commands.Cog):
@@ -26,88 +29,102 @@ class ParserCog(commands.Cog):
 
     def parse(self, string: str, flagdata: FlagData) -> Scene:
         """Parses a string into a scene."""
-        # Parse flags
-        matches = [match for match in re.finditer(r"\s*--([^=\s]+)(?:=(\S+))?\s*", string)]
-        matches.reverse()  # so that removing a match doesn't mess up other matches
+        string, ground = self.parse_flags(string, flagdata)
+        bounds = SceneBounds()
+        parsed_tiles = list(self.iter_tiles(string, ground, bounds))
+        self.bot.variant_handler.check_colors((tile.variants for tile in parsed_tiles), flagdata.palette)
+
+        # Sort tiles
+        parsed_tiles.sort()
+
+        return Scene(
+            bounds.width,
+            bounds.height,
+            bounds.min_depth,
+            bounds.max_depth,
+            bounds.pixel_depth,
+            parsed_tiles
+        )
+
+    def parse_columns(self, string: str, flagdata: FlagData) -> ColumnarScene:
+        """Parses a string into a columnar scene, without keeping an object around for each tile."""
+        string, ground = self.parse_flags(string, flagdata)
+        bounds = SceneBounds()
+        scene = ColumnarScene.from_tiles(self.iter_tiles(string, ground, bounds), bounds)
+        self.bot.variant_handler.check_colors(scene.chains, flagdata.palette)
+        return scene
+
+    def parse_flags(self, string: str, flagdata: FlagData) -> tuple[str, str]:
+        """Parses the flags out of a string into the flag data, returning the rest of the string and the ground tile."""
+        # Parse flags, removing them from the string as we go
         flags = {}
-        for match in matches:
-            # Remove the flag
-            string = string[:match.start()] + string[match.end():]
+
+        def take_flag(match: re.Match) -> str:
             key, value = match.groups()
-            flags[key] = value
+            # The first time a flag is given wins
+            flags.setdefault(key, value)
+            return ""
+
+        string = FLAG_PATTERN.sub(take_flag, string)
         ground = flags["ground"] if "ground" in flags else "terrain_0"
+        flagdata.ground = ground
         if "bg" in flags:
             value = flags["bg"]
             if value.startswith("#"):
                 color_string = flags["bg"][1:]
-                color_int = int(color_string, base=16)
+                try:
+                    color_int = int(color_string, base=16)
+                except ValueError:
+                    raise CustomError(f"`{value}` isn't a hex color.")
                 background = ((color_int & 0xFF0000) >> 16, (color_int & 0xFF00) >> 8, color_int & 0xFF, 0xFF)
                 flagdata.background = background
             elif value == "transparent":
                 flagdata.background = (0x00, 0x00, 0x00, 0x00)
-        # Split string into lines, then cells, then stack, then time
-        rows = string.split("\n")
-        parsed_tiles = []
-        dims = (0.0, 0.0, (0.0, 0.0), 0.0)
-        for y, row in enumerate(rows):
-            stacks = row.split(" ")
-            for x, stack in enumerate(stacks):
-                maybe_terrain = stack.split("%", 1)
-                if len(maybe_terrain) == 2:
-                    stack = maybe_terrain[1]
-                    terrain = maybe_terrain[0]
+        if "format" in flags:
+            value = flags["format"]
+            if value not in FORMATS:
+                raise CustomError(f"Can't save as `{value}`. Try one of {', '.join(FORMATS)}.")
+            flagdata.format = value
+        if "palette" in flags:
+            value = flags["palette"]
+            self.bot.variant_handler.colors.check_palette(value)
+            flagdata.palette = value
+        return string, ground
+
+    def iter_tiles(self, string: str, ground: str, bounds: SceneBounds) -> Iterator[Tile]:
+        """Parses the tiles out of a scene string with its flags removed, one at a time.
+
+        Rows are split by newlines, cells by spaces, stacks by &, and pixel layers by |.
+        A cell can start with a terrain override before a %."""
+        for y, row in enumerate(string.split("\n")):
+            for x, stack in enumerate(row.split(" ")):
+                terrain, percent, rest = stack.partition("%")
+                if not percent:
+                    stack, terrain = terrain, ground
                 else:
-                    stack = maybe_terrain[0]
-                    terrain = ground
-                steps = re.split(r"(?!\\\\)&", stack)
+                    stack = rest
 
                 offset = 0
-                for z, step in enumerate(steps):
-                    tiles = step.split("|")
-                    for p, tile in enumerate(tiles):
-                        try:
-                            parsed, dims, this_offset = self.parse_cell((x, y, z, p), tile, dims)
-                        except TypeError:
+                for z, step in enumerate(stack.split("&")):
+                    for p, name in enumerate(step.split("|")):
+                        tile = self.parse_cell(x, y, z, p, name, bounds)
+                        if tile is None:
                             continue
-                        offset = max(this_offset, offset)
-                        parsed_tiles.append(parsed)
+                        if tile.data.ground_height > offset:
+                            offset = tile.data.ground_height
+                        yield tile
 
                 # Handle terrain
-                terrain_parts = terrain.split("|")
-                for p, floor in enumerate(terrain_parts):
-                    try:
-                        parsed, dims, _ = self.parse_cell((x, y, -1 - (offset / 4), p), floor, dims)
-                    except TypeError:
-                        continue
-                    parsed_tiles.append(parsed)
-
-        # Sort tiles
-        parsed_tiles.sort()
+                for p, floor in enumerate(terrain.split("|")):
+                    tile = self.parse_cell(x, y, -1 - (offset / 4), p, floor, bounds)
+                    if tile is not None:
+                        tile.floor = not percent
+                        yield tile
 
-        return Scene(
-            dims[0],
-            dims[1],
-            dims[2][0],
-            dims[2][1],
-            dims[3],
-            parsed_tiles
-        )
-
-    def parse_cell(
-            self,
-            position: tuple[float, float, float, float],
-            name: str,
-            dimensions: tuple[float, float, tuple[float, float], float]
-    ) -> tuple[Tile, tuple[float, float, tuple[float, float], float], int] | None:
-        """Parses a single cell."""
-        width = max(dimensions[0], position[0])
-        height = max(dimensions[1], position[1])
-        max_depth = max(dimensions[2][1], position[2])
-        min_depth = min(dimensions[2][0], position[2])
-        pixel_depth = max(dimensions[3], position[3])
-        dimensions = (width, height, (min_depth, max_depth), pixel_depth)
-
-        name = re.sub(r"\\(.)", r"\1", name)
+    def parse_cell(self, x: float, y: float, z: float, p: float, name: str, bounds: SceneBounds) -> Tile | None:
+        """Parses a single cell, growing the bounds to fit it. Empty cells give None."""
+        if "\\" in name:
+            name = ESCAPE_PATTERN.sub(r"\1", name)
         name, *variants = name.split(":")
         name: str
         if name in [".", ""]:  # Empty
@@ -119,26 +136,23 @@ class ParserCog(commands.Cog):
         data = self.bot.data.data.get(name)
         if data is None:
             if name.startswith("text_"):
-                data = TileData(directional=False, ground_height=0, frames=1, unit=True, directory="custom_text_")
+                data = CUSTOM_TEXT_DATA
             else:
                 raise CustomError(f"There's no tile called `{name}`.")
-        offset = data.ground_height
+        bounds.include(x, y, z, p)
         variants = [
             Variant.from_string(var) for var in variants
         ]
-        data_copy = data.copy()
-        # noinspection PyTypeChecker
-        # false alarm
-        variants_copy = variants.copy()
+        # The data is shared with every other tile of this name until a variant changes it
         tile = Tile(
             name,
-            *position,
+            x, y, z, p,
+            variants,
             variants,
-            variants_copy,
-            data_copy
+            data
         )
         tile = self.bot.variant_handler.handle_tile_variants(tile)
-        return tile, dimensions, offset
+        return tile
 
 
 async def setup(bot: Bot):
@@ -1,34 +1,43 @@
+import asyncio
 import io
-from locale import currency
 from pathlib import Path
 
-import cv2
 from PIL import Image
 import numpy as np
 from datetime import datetime
 import discord
 from discord.ext import commands
-from io import BytesIO
 
-import itertools
-import math
+import time
 
 from typing import TYPE_CHECKING
 
+from attrs import define
+
+import config
+import scheduler
+import tracing
+from atlas import Atlas, load_atlas, source_path
+from cache import LRUCache, image_size
+from colors import ColorStats
+from compositor import COMPOSITORS, alpha_composite
+from encoder import encode
 from coggers.data import TileData, FlagData
-from classes import CustomError, Tile
+from classes import CustomError, Scene, ColumnarScene
 
 if TYPE_CHECKING:
     from ROBOT import Bot
-    from coggers.parser import Scene, Variant
 else:
-    class Scene:
-        pass
-
-
     class Bot:
         pass
 
+# About how many canvas-sized RGBA arrays compositing a frame needs at once, for fitting strips into the memory budget
+WORKING_COPIES = 6
+# Strips are never made thinner than this, however wide the canvas is
+MIN_STRIP_HEIGHT = 32
+# How big of a grid tiles are bucketed into by where they're drawn, for finding which ones overlap
+CELL_SIZE = 32
+
 CUSTOM_WIDTH = {
     2: 11,
     3: 13,
@@ -42,130 +51,573 @@ CUSTOM_HEIGHT = {
 }
 
 
+def fit_widths(options: list[list[int]], target: int) -> tuple[list[int], int]:
+    """Picks a width for each letter and a spacing of 1 or 2 between them,
+    getting the line as close to the target length as possible.
+
+    Ties go to a spacing of 1, then to the narrowest letters first.
+    The widths of each letter need to be sorted."""
+    # reachable[i] holds every total width that the letters from i onwards can add up to
+    reachable = [{0}]
+    for widths in reversed(options):
+        reachable.append({total + width for total in reachable[-1] for width in widths})
+    reachable.reverse()
+
+    best = None
+    for spacing in (1, 2):
+        gaps = spacing * (len(options) - 1)
+        dist = min(abs(total + gaps - target) for total in reachable[0])
+        if best is None or dist < best[0]:
+            best = (dist, spacing)
+    dist, spacing = best
+    gaps = spacing * (len(options) - 1)
+    totals = {total for total in (target - gaps - dist, target - gaps + dist) if total in reachable[0]}
+
+    solution = []
+    for i, widths in enumerate(options):
+        width = next(
+            width for width in widths
+            if any(total - width in reachable[i + 1] for total in totals)
+        )
+        solution.append(width)
+        totals = {total - width for total in totals}
+    return solution, spacing
+
+
+def merge_rects(rects: list[tuple[int, int, int, int]]) -> list[tuple[int, int, int, int]]:
+    """Merges (left, top, right, bottom) rectangles that overlap into their bounding boxes, until none of them overlap."""
+    merged = []
+    for rect in rects:
+        merging = True
+        while merging:
+            merging = False
+            for i, other in enumerate(merged):
+                if rect[0] < other[2] and other[0] < rect[2] and rect[1] < other[3] and other[1] < rect[3]:
+                    rect = (min(rect[0], other[0]), min(rect[1], other[1]), max(rect[2], other[2]), max(rect[3], other[3]))
+                    merged.pop(i)
+                    merging = True
+                    break
+        merged.append(rect)
+    return merged
+
+
+def concat_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Gets start, start + 1, ... up to count numbers from each start, all in one array."""
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+def box_cells(boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Gets every (cell, box) pair of a grid of CELL_SIZE cells and the (left, top, right, bottom) boxes touching them."""
+    left, top = boxes[:, 0] // CELL_SIZE, boxes[:, 1] // CELL_SIZE
+    columns = (boxes[:, 2] - 1) // CELL_SIZE - left + 1
+    counts = columns * ((boxes[:, 3] - 1) // CELL_SIZE - top + 1)
+    owners = np.repeat(np.arange(len(boxes)), counts)
+    offsets = concat_ranges(np.zeros(len(boxes), dtype=np.int64), counts)
+    cells = (top[owners] + offsets // columns[owners]) * (1 << 32) + left[owners] + offsets % columns[owners]
+    return cells, owners
+
+
+def earlier_overlaps(boxes: np.ndarray, ranks: np.ndarray, others: np.ndarray, other_ranks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Gets the indices of every pair of a box and another box that's ranked after it and overlaps it.
+
+    Boxes are only compared with those sharing a cell of the grid, so this doesn't compare every pair."""
+    if not (len(boxes) and len(others)):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cells, owners = box_cells(boxes)
+    order = np.argsort(cells, kind="stable")
+    cells, owners = cells[order], owners[order]
+    other_cells, other_owners = box_cells(others)
+    starts = np.searchsorted(cells, other_cells, "left")
+    counts = np.searchsorted(cells, other_cells, "right") - starts
+    first = owners[concat_ranges(starts, counts)]
+    second = np.repeat(other_owners, counts)
+    a, b = boxes[first], others[second]
+    overlapping = (a[:, 0] < b[:, 2]) & (b[:, 0] < a[:, 2]) & (a[:, 1] < b[:, 3]) & (b[:, 1] < a[:, 3])
+    found = overlapping & (ranks[first] < other_ranks[second])
+    # Boxes sharing more than one cell would come up more than once
+    pairs = np.unique(first[found] * len(others) + second[found])
+    return pairs // len(others), pairs % len(others)
+
+
+def floor_size(entry: tuple[list | None, list, np.ndarray, np.ndarray]) -> int:
+    """Gets how many bytes a cached floor takes up, not counting its sprites, which are shared."""
+    layer, _, boxes, keys = entry
+    size = boxes.nbytes + keys.nbytes
+    if layer is not None:
+        for wobble, ((arr, mask), _, _) in enumerate(layer):
+            if not wobble or layer[wobble] is not layer[wobble - 1]:
+                size += arr.nbytes + (mask.nbytes if mask is not None else 0)
+    return size
+
+
+@define
+class RecentRender:
+    """What's kept of a render so that editing its command can redo only what changed."""
+
+    """The scene that was rendered."""
+    scene: ColumnarScene
+
+    """The flags it was rendered with."""
+    flagdata: FlagData
+
+    """The frames it came out as, if they were small enough to keep."""
+    frames: list[np.ndarray] | None
+
+    """The message the render was sent in."""
+    reply: discord.Message
+
+
 # noinspection PyMethodMayBeStatic
 class RenderCog(commands.Cog):
-    sprite_cache: dict[str, Image]
-    letter_cache: dict[str, Image]
+    """Cog for rendering scenes."""
+
+    """The packed sprites from setup.py, if they've been built."""
+    atlas: Atlas | None
+
+    """Sprites decoded from their files when they aren't in the atlas, keyed by (name, directory, direction, wobble frame)."""
+    sprite_cache: LRUCache
+
+    """Custom text letters, as letters[char][letter mode][width]."""
+    letters: dict[str, dict[int, dict[int, np.ndarray]]]
+
+    """Finished custom text sprites, keyed by word."""
+    text_cache: LRUCache
+
+    """Color statistics of sprites that aren't in the atlas, keyed like sprite_cache."""
+    stats_cache: LRUCache
+
+    """Sprites that the compositor has made ready to blit, with their unit outlines, kept between renders."""
+    prepared_cache: LRUCache
+
+    """The latest renders, keyed by the ID of the message that asked for them."""
+    recent: LRUCache
+
+    """The ground under scenes' cells composited into a layer for each wobble frame, with the bounds and drawing order
+    of each of its tiles, keyed by the compositor, the scene's bounds, the ground, the palette and the ground's tiles."""
+    floor_cache: LRUCache
 
     def __init__(self, bot: Bot):
         self.bot = bot
-        self.sprite_cache = {"-": None, "": None}
+        self.atlas = load_atlas()
+        self.sprite_cache = LRUCache(config.sprite_cache_size, image_size)
+        self.text_cache = LRUCache(config.text_cache_size, image_size)
+        self.stats_cache = LRUCache(config.stats_cache_size, lambda stats: stats.colors.nbytes + stats.counts.nbytes)
+        self.prepared_cache = LRUCache(config.prepared_cache_size, lambda entry: entry[1][0].nbytes * 2)
+        self.floor_cache = LRUCache(config.floor_cache_size, floor_size)
+        self.recent = LRUCache(
+            config.edit_cache_size,
+            lambda recent: 1024 + (recent.frames[0].nbytes * 3 if recent.frames is not None else 0)
+        )
+        self.load_letters()
 
     SPACING: int = 12
-    UNIT_KERNEL: np.ndarray = np.array([
-        [0, 1, 0],
-        [1, -6, 1],
-        [1, 1, 1]
-    ])
-
-    def recolor(self, sprite: Image.Image | np.ndarray, rgba: tuple[int, int, int, int]) -> Image.Image | np.ndarray:
-        """Apply rgba color multiplication. (0-255)"""
-        arr = np.multiply(sprite, np.array(rgba) / 255, casting="unsafe").astype(np.uint8)
-        if isinstance(sprite, np.ndarray):
-            return arr
-        return Image.fromarray(arr)
-
-    async def render_scene(self, scene: Scene, flagdata: FlagData) -> list[Image]:
-        width = (scene.width + scene.height + 4) * self.SPACING
-        height = (scene.height + scene.width + 6 + ((scene.max_depth - scene.min_depth) * 2)) * (self.SPACING // 2)
-        bg = Image.new("RGBA", (int(width), int(height)), flagdata.background)
-        empty = Image.new("RGBA", (int(width), int(height)), (0, 0, 0, 0))
-        final = []
 
-        for wobble in range(3):
-            frame = empty.copy()
-            background = bg.copy()
-            back_array = np.array(background)
-            back_array[..., :3][back_array[..., :3] < 0x08] = 0x08
-            background = Image.fromarray(back_array)
+    def render_scene(self, scene: Scene | ColumnarScene, flagdata: FlagData, engine: str | None = None) -> list[np.ndarray]:
+        """Renders a scene into its wobble frames, as RGBA arrays at 1x scale.
+
+        The engine picks the compositor, defaulting to the configured one.
+        Canvases too big to composite within config.render_memory_budget are done a strip at a time."""
+        width, height = self.frame_size(scene)
+        compositor_type = COMPOSITORS[engine or config.render_engine]
+        strip_height = self.strip_height(width)
+        if height > strip_height:
+            return self.render_strips(scene, flagdata, compositor_type, strip_height)
+        compositor = compositor_type(width, height, flagdata.background, self.prepared_cache)
+        floor, plan = self.plan_with_floor(scene, compositor, flagdata)
+        return self.composite(plan, compositor, floor)
+
+    def composite(
+            self, plan: list[list[tuple[object, int, int]]], compositor, floor: list[tuple[object, int, int]] | None = None
+    ) -> list[np.ndarray]:
+        """Composites a plan into the compositor's wobble frames, on top of a floor layer's draws if there is one."""
+        trace = tracing.current()
+        if compositor.layers:
+            with trace.span("layer"):
+                plan = self.layer_static_runs(plan, compositor)
+        if floor is not None:
+            # It's already a layer, so it'd only be copied again as part of a run
+            plan = [floor] + plan
+        animated = any(not (draws[0] is draws[1] is draws[2]) for draws in plan)
+        final = []
 
-            for tile in scene.tiles:
-                tile: Tile
+        for wobble in range(3 if animated else 1):
+            with trace.span("composite"):
+                compositor.new_frame()
+                for draws in plan:
+                    compositor.blit(*draws[wobble])
+            with trace.span("outline"):
+                final.append(compositor.finish_frame())
+
+        if not animated:
+            # Every frame would come out the same
+            return final * 3
+        return final
 
-                # Reload the running variants
-                tile.running_variants = tile.variants.copy()
-                print("----")
-                print(tile.running_variants)
+    def strip_height(self, width: int) -> int:
+        """Gets how many rows of a canvas this wide can be composited at once within the memory budget."""
+        return max(config.render_memory_budget // (width * 4 * WORKING_COPIES), MIN_STRIP_HEIGHT)
+
+    def render_strips(self, scene: Scene | ColumnarScene, flagdata: FlagData, compositor_type, strip_height: int) -> list[np.ndarray]:
+        """Renders a scene a horizontal strip at a time, so that only the finished frames are ever the size of the canvas.
+
+        Each strip is composited with what's up to two pixels above it too, since outlines depend on that,
+        so the strips come out the same as the whole canvas would have."""
+        width, height = self.frame_size(scene)
+        trace = tracing.current()
+        # Only used for preparing sprites, which doesn't depend on the size
+        planner = compositor_type(width, 1, flagdata.background, self.prepared_cache)
+        plan = self.plan_scene(scene, planner, flagdata.palette)
+
+        with trace.span("index"):
+            # Which tiles touch each strip, in drawing order
+            strips: list[list[int]] = [[] for _ in range((height + strip_height - 1) // strip_height)]
+            for i, draws in enumerate(plan):
+                top = min(y for _, _, y in draws)
+                bottom = max(y + planner.size(sprite)[1] for sprite, _, y in draws)
+                first = max(top // strip_height, 0)
+                last = min((bottom + 1) // strip_height, len(strips) - 1)
+                for strip in range(first, last + 1):
+                    strips[strip].append(i)
+
+        animated = any(not (draws[0] is draws[1] is draws[2]) for draws in plan)
+        frames = [np.empty((height, width, 4), dtype=np.uint8) for _ in range(3 if animated else 1)]
+        for strip, indices in enumerate(strips):
+            top = strip * strip_height
+            bottom = min(top + strip_height, height)
+            region_top = max(top - 2, 0)
+            region = compositor_type(width, bottom - region_top, flagdata.background, self.prepared_cache)
+            strip_plan = []
+            for i in indices:
+                draws = []
+                for wobble, draw in enumerate(plan[i]):
+                    # Draws that are the same object have to stay that way, since that's how static tiles are told apart
+                    if wobble and draw is plan[i][wobble - 1]:
+                        draws.append(draws[-1])
+                    else:
+                        sprite, x, y = draw
+                        draws.append((sprite, x, y - region_top))
+                strip_plan.append(draws)
+            for frame, redrawn in zip(frames, self.composite(strip_plan, region)):
+                frame[top:bottom] = redrawn[top - region_top:]
+        if not animated:
+            return frames * 3
+        return frames
+
+    def frame_size(self, scene: Scene | ColumnarScene) -> tuple[int, int]:
+        """Gets the width and height that a scene renders at, at 1x scale."""
+        width = (scene.width + scene.height + 4) * self.SPACING
+        height = (scene.height + scene.width + 6 + ((scene.max_depth - scene.min_depth) * 2)) * (self.SPACING // 2)
+        return int(width), int(height)
+
+    def render_changes(
+            self, scene: ColumnarScene, flagdata: FlagData,
+            previous: tuple[ColumnarScene, list[np.ndarray]], engine: str | None = None
+    ) -> list[np.ndarray]:
+        """Renders a scene by redrawing an earlier render of another one only where tiles were added or removed.
+
+        Falls back to rendering all of it when the two scenes aren't laid out the same, or when most of it changed."""
+        old_scene, old_frames = previous
+        if old_scene.bounds() != scene.bounds():
+            return self.render_scene(scene, flagdata, engine)
+        width, height = self.frame_size(scene)
+        compositor_type = COMPOSITORS[engine or config.render_engine]
+        compositor = compositor_type(width, height, flagdata.background, self.prepared_cache)
+        trace = tracing.current()
+
+        with trace.span("diff"):
+            removed, added = scene.changes(old_scene)
+            rects = self.draw_rects(self.plan_scene(old_scene.take(removed), compositor, flagdata.palette), compositor)
+            rects += self.draw_rects(self.plan_scene(scene.take(added), compositor, flagdata.palette), compositor)
+            # Outlines reach up to two pixels down and right of what they're around
+            rects = merge_rects([
+                (left, top, min(right + 2, width), min(bottom + 2, height))
+                for left, top, right, bottom in rects
+            ])
+        if sum((right - left) * (bottom - top) for left, top, right, bottom in rects) > width * height // 2:
+            return self.render_scene(scene, flagdata, engine)
+
+        frames = [frame.copy() for frame in old_frames]
+        if not len(rects):
+            return frames
+        plan = self.plan_scene(scene, compositor, flagdata.palette)
+        boxes = [
+            np.array([(x, y, *compositor.size(sprite)) for sprite, x, y in (draws[wobble] for draws in plan)]).reshape(-1, 4)
+            for wobble in range(3)
+        ]
+        for left, top, right, bottom in rects:
+            # Outlines also depend on what's up to two pixels up and left of them
+            region_left, region_top = max(left - 2, 0), max(top - 2, 0)
+            region = compositor_type(right - region_left, bottom - region_top, flagdata.background, self.prepared_cache)
+            for wobble in range(3):
+                x, y, w, h = boxes[wobble].T
+                touching = np.flatnonzero((x < right) & (y < bottom) & (x + w > region_left) & (y + h > region_top))
+                with trace.span("composite"):
+                    region.new_frame()
+                    for i in touching.tolist():
+                        sprite, x_pos, y_pos = plan[i][wobble]
+                        region.blit(sprite, x_pos - region_left, y_pos - region_top)
+                with trace.span("outline"):
+                    redrawn = region.finish_frame()
+                frames[wobble][top:bottom, left:right] = redrawn[top - region_top:, left - region_left:]
+        return frames
+
+    def draw_rects(self, plan: list[list[tuple[object, int, int]]], compositor) -> list[tuple[int, int, int, int]]:
+        """Gets the (left, top, right, bottom) that each tile of a plan covers over all of its frames."""
+        width, height = compositor.frame_size()
+        rects = []
+        for draws in plan:
+            left, top, right, bottom = width, height, 0, 0
+            for sprite, x, y in draws:
+                sprite_width, sprite_height = compositor.size(sprite)
+                left, top = min(left, x), min(top, y)
+                right, bottom = max(right, x + sprite_width), max(bottom, y + sprite_height)
+            left, top = max(left, 0), max(top, 0)
+            right, bottom = min(right, width), min(bottom, height)
+            if left < right and top < bottom:
+                rects.append((left, top, right, bottom))
+        return rects
+
+    def plan_with_floor(
+            self, scene: Scene | ColumnarScene, compositor, flagdata: FlagData
+    ) -> tuple[list[tuple[object, int, int]] | None, list[list[tuple[object, int, int]]]]:
+        """Plans a scene like plan_scene, but with the ground under its cells split out into one cached layer to draw first.
+
+        Returns the layer's draws and the plan of everything else. The ground's only split out when it'd come out the same,
+        which is when nothing drawn before any of it overlaps it. Otherwise, there's no layer and the whole scene is planned."""
+        if not (compositor.layers and isinstance(scene, ColumnarScene) and scene.floor.any()):
+            return None, self.plan_scene(scene, compositor, flagdata.palette)
+        trace = tracing.current()
+        rest = scene.take(~scene.floor)
+        rows = []
+        plan = self.plan_scene(rest, compositor, flagdata.palette, rows)
+        with trace.span("floor"):
+            floors = scene.take(scene.floor)
+            key = (type(compositor), scene.bounds(), flagdata.ground, flagdata.palette, floors.digest())
+            entry = self.floor_cache.get(key)
+            if entry is None:
+                entry = self.plan_floor(floors, compositor, flagdata.palette)
+                self.floor_cache[key] = entry
+            layer, floor_plan, boxes, keys = entry
+            rest_keys = np.stack((rest.y - rest.x, rest.z, rest.p), axis=-1)[rows]
+            all_keys = np.concatenate((rest_keys, keys))
+            # Ties go to the rest of the tiles, so that they count as drawn first
+            is_floor = np.repeat((0, 1), (len(rest_keys), len(keys)))
+            ranks = np.empty(len(all_keys), dtype=np.int64)
+            ranks[np.lexsort((is_floor, all_keys[:, 2], all_keys[:, 1], all_keys[:, 0]))] = np.arange(len(all_keys))
+            moved = layer is None
+            if not moved:
+                first, second = earlier_overlaps(
+                    self.plan_boxes(plan, compositor), ranks[:len(rest_keys)], boxes, ranks[len(rest_keys):]
+                )
+                # Boxes overlapping doesn't mean that any pixels do
+                moved = any(
+                    compositor.overlaps(plan[i][wobble], floor_plan[j][wobble])
+                    for i, j in zip(first.tolist(), second.tolist())
+                    for wobble in range(3)
+                    if not (wobble and plan[i][wobble] is plan[i][wobble - 1] and floor_plan[j][wobble] is floor_plan[j][wobble - 1])
+                )
+        if moved:
+            return None, self.plan_scene(scene, compositor, flagdata.palette)
+        return layer, plan
+
+    def plan_floor(self, floors: ColumnarScene, compositor, palette: str) -> tuple[list | None, list, np.ndarray, np.ndarray]:
+        """Composites the ground of a scene into a layer for each wobble frame.
+
+        Returns the layers, which are None if any came out empty or the ground can't be layered, along with the plan, bounds and (y - x, z, p) of each tile."""
+        rows = []
+        plan = self.plan_scene(floors, compositor, palette, rows)
+        keys = np.stack((floors.y - floors.x, floors.z, floors.p), axis=-1)[rows]
+        # Semi-transparent ground can't be layered, so then it's left to the whole scene's plan
+        if not all(compositor.layerable(sprite) for draws in plan for sprite, _, _ in draws):
+            return None, plan, self.plan_boxes(plan, compositor), keys
+        layer = []
+        for wobble in range(3):
+            if wobble and all(draws[wobble] is draws[wobble - 1] for draws in plan):
+                layer.append(layer[-1])
+            else:
+                layer.append(compositor.layer([draws[wobble] for draws in plan]) if len(plan) else None)
+        if any(draw is None for draw in layer):
+            layer = None
+        return layer, plan, self.plan_boxes(plan, compositor), keys
+
+    def plan_boxes(self, plan: list[list[tuple[object, int, int]]], compositor) -> np.ndarray:
+        """Gets the (left, top, right, bottom) that each tile of a plan covers over all of its frames, unclipped."""
+        boxes = np.empty((len(plan), 4), dtype=np.int64)
+        for i, draws in enumerate(plan):
+            left, top, right, bottom = draws[0][1], draws[0][2], draws[0][1], draws[0][2]
+            for sprite, x, y in draws:
+                width, height = compositor.size(sprite)
+                left, top = min(left, x), min(top, y)
+                right, bottom = max(right, x + width), max(bottom, y + height)
+            boxes[i] = left, top, right, bottom
+        return boxes
+
+    def plan_scene(
+            self, scene: Scene | ColumnarScene, compositor, palette: str, rows: list[int] | None = None
+    ) -> list[list[tuple[object, int, int]]]:
+        """Works out the (sprite, x, y) that each tile draws on each wobble frame.
+
+        Tiles whose sprite doesn't change between frames get the same draw for all of them,
+        so their sprite and variants are only handled once.
+        Tiles without a sprite are left out, so if a list of rows is given, each planned tile's index is added to it."""
+        trace = tracing.current()
+        plan = []
+        for row, (name, x, y, z, p, direction, variants, data) in enumerate(scene.rows()):
+            draws = []
+            last_key = None
+            for wobble in range(3):
+                key = self.sprite_key(name, data, direction, wobble)
+                if key == last_key:
+                    draws.append(draws[-1])
+                    continue
+                last_key = key
 
                 # Add sprites to tile
-                sprite = self.get_sprite(tile, wobble)
+                start = time.perf_counter()
+                sprite = self.get_sprite(key)
                 if sprite is None:
-                    continue
-                data = self.bot.data.data.get(tile.name)
-                if data is None:
-                    data = TileData(directional=False, ground_height=0, frames=1, unit=True, directory="custom_text_")
+                    break
+                after_sprite = time.perf_counter()
+                trace.add("sprites", after_sprite - start)
 
                 # Handle sprite variants
-                sprite = self.bot.variant_handler.handle_sprite_variants(tile, sprite)
-
-                if tile.data.unit:
-                    sprite = np.array(sprite)
-                    sprite = np.pad(sprite, ((1, 1), (1, 1), (0, 0)))
-                    base = sprite[..., 3]
-                    base = cv2.filter2D(src=base, ddepth=-1, kernel=self.UNIT_KERNEL)
-                    base = np.dstack((base, base, base, base))
-                    mask = sprite[..., 3] > 0
-                    base[mask, ...] = 0
-                    base = self.recolor(base, (8, 8, 8, 255))
-                    base = Image.fromarray(base)
-                    sprite = Image.fromarray(sprite)
-                    sprite.alpha_composite(base)
+                sprite = self.bot.variant_handler.handle_sprite_variants(variants, sprite, key, palette)
+                after_variants = time.perf_counter()
+                trace.add("variants", after_variants - after_sprite)
+
+                sprite, sprite_width, sprite_height = compositor.prepare(sprite, data.unit)
+                trace.add("prepare", time.perf_counter() - after_variants)
                 # Adjust coordinates for 3D isometric view
-                x_pos = (tile.x + tile.y + 2) * self.SPACING - sprite.width // 2
+                x_pos = (x + y + 2) * self.SPACING - sprite_width // 2
                 y_pos = (
-                        (tile.y - tile.x + scene.width + 3 + scene.max_depth * 2)
+                        (y - x + scene.width + 3 + scene.max_depth * 2)
                         * (self.SPACING // 2)
-                        - sprite.height // 2
+                        - sprite_height // 2
                         + data.ground_height * 3
-                        - tile.z * self.SPACING
+                        - z * self.SPACING
                 )
-                frame.alpha_composite(sprite, (int(x_pos), int(y_pos)))
-
-            frame = np.array(frame)
-            frame = np.pad(frame, ((1, 1), (1, 1), (0, 0)))
-            base = frame[..., 3]
-            base = cv2.filter2D(src=base, ddepth=-1, kernel=self.UNIT_KERNEL)
-            base = np.dstack((base, base, base, base))
-            mask = frame[..., 3] > 0
-            base[mask, ...] = 0
-            base = self.recolor(base, (8, 8, 8, 255))
-            base = Image.fromarray(base)
-            frame = Image.fromarray(frame)
-            frame.alpha_composite(base)
-            background.alpha_composite(frame)
-            frame = background
-
-            frame = frame.resize((frame.width * 2, frame.height * 2), Image.Resampling.NEAREST)
-
-            final.append(frame)
-
-        return final
-
-    def get_sprite(self, tile: Tile, wobble: int) -> Image.Image | None:
-        name = tile.name
-        key = f"{name} {wobble} {tile.direction}"
-        if key in self.sprite_cache and False:
-            return self.sprite_cache[key]
-
-        if tile.data.directory == "custom_text_":
-            img = self.custom_text(name)
-        else:
-            data: TileData = self.bot.data.data.get(name)
-            if data.frames == 1:
-                wobble = 0
-            infix = f"_{tile.direction}_" if data.directional else "_"
-            path = "sprites/" + name + infix + str(wobble + 1) + ".png"
-            try:
-                path = Path("data", data.directory, path)
-                with Image.open(path) as im:
-                    img = im.convert("RGBA").copy()
-            except FileNotFoundError:
-                raise CustomError(f"Files for `{name}` not found.\nPath: `{path}`")
+                draws.append((sprite, int(x_pos), int(y_pos)))
+            else:
+                plan.append(draws)
+                if rows is not None:
+                    rows.append(row)
+        return plan
+
+    def layer_static_runs(self, plan: list[list[tuple[object, int, int]]], compositor) -> list[list[tuple[object, int, int]]]:
+        """Flattens each run of tiles that don't animate and can be layered into a single layer, so it's composited once for all frames."""
+        layered = []
+        run = []
+
+        def flush():
+            if len(run) > 1:
+                layer = compositor.layer(run)
+                if layer is not None:
+                    layered.append([layer] * 3)
+            elif len(run):
+                layered.append([run[0]] * 3)
+            run.clear()
+
+        for draws in plan:
+            if draws[0] is draws[1] is draws[2] and compositor.layerable(draws[0][0]):
+                run.append(draws[0])
+            else:
+                flush()
+                layered.append(draws)
+        flush()
+        return layered
+
+    def compare_engines(self, scene: Scene | ColumnarScene, flagdata: FlagData) -> dict[str, list[int]]:
+        """Renders a scene with every compositor, counting how many pixels of each frame differ from PIL's."""
+        reference = self.render_scene(scene, flagdata, "pil")
+        differences = {}
+        for engine in COMPOSITORS:
+            if engine == "pil":
+                continue
+            frames = self.render_scene(scene, flagdata, engine)
+            differences[engine] = [
+                int(np.any(frame != ref, axis=-1).sum()) if frame.shape == ref.shape else -1
+                for frame, ref in zip(frames, reference)
+            ]
+        return differences
+
+    def sprite_key(self, name: str, data: TileData, direction: int, wobble: int) -> tuple[str, str, int, int]:
+        """Gets the (name, directory, direction, wobble frame) that a tile's sprite is cached under."""
+        if data.directory == "custom_text_":
+            return name, data.directory, 0, 0
+        if data.frames == 1:
+            wobble = 0
+        if not data.directional:
+            direction = 0
+        return name, data.directory, direction, wobble
+
+    def get_sprite(self, key: tuple[str, str, int, int]) -> np.ndarray | None:
+        """Gets the sprite under a sprite key as an RGBA array. The returned array is shared, so don't modify it."""
+        if key[1] == "custom_text_":
+            # These have their own cache
+            return self.custom_text(key[0])
+        name, directory, _, _ = key
+        stem = self.sprite_stem(key)
+        if self.atlas is not None:
+            img = self.atlas.get(f"{directory}/{stem}")
+            if img is not None:
+                return img
+
+        # Not packed, so fall back to the file
+        img = self.sprite_cache.get(key)
+        if img is not None:
+            return img
+        try:
+            path = Path("data", directory, "sprites", stem + ".png")
+            with Image.open(path) as im:
+                img = np.array(im.convert("RGBA"))
+        except FileNotFoundError:
+            raise CustomError(f"Files for `{name}` not found.\nPath: `{path}`")
+        img.flags.writeable = False
         self.sprite_cache[key] = img
         return img
 
+    def sprite_stem(self, key: tuple[str, str, int, int]) -> str:
+        """Gets the file name that the sprite under a sprite key has, without its extension."""
+        name, _, direction, wobble = key
+        infix = f"_{direction}_" if self.bot.data.data[name].directional else "_"
+        return name + infix + str(wobble + 1)
+
+    def color_stats(self, key: tuple[str, str, int, int]) -> ColorStats:
+        """Gets the color statistics of the sprite under a sprite key, which the atlas has for every sprite in it."""
+        if key[1] != "custom_text_" and self.atlas is not None:
+            stats = self.atlas.color_stats(f"{key[1]}/{self.sprite_stem(key)}")
+            if stats is not None:
+                return stats
+        stats = self.stats_cache.get(key)
+        if stats is None:
+            stats = ColorStats.of(self.get_sprite(key))
+            self.stats_cache[key] = stats
+        return stats
+
+    def load_letters(self):
+        """Loads the custom text letters, from the atlas if there is one and from disk if not."""
+        self.letters = {}
+        letters = []
+        paths = Path("data", "special", "letters").glob("*/*.png")
+        if self.atlas is not None:
+            letters = [(key.split("/")[1:], self.atlas.get(key)) for key in self.atlas.keys("letters/")]
+            # Only the ones that changed since the atlas was built are read from their files
+            paths = [source_path(key) for key in self.atlas.stale if key.startswith("letters/")]
+        for path in paths:
+            if not path.exists():
+                continue
+            with Image.open(path) as im:
+                letters.append(((path.parent.name, path.stem), np.array(im.convert("RGBA"))))
+        for (char, stem), img in letters:
+            letter_mode, width = stem.split("_")
+            self.letters.setdefault(char, {}).setdefault(int(letter_mode), {})[int(width)] = img
+
     def custom_text(self, name):
         word = name.removeprefix("text_").lower()
+        img = self.text_cache.get(word)
+        if img is not None:
+            return img
         word_len = len(word)
         if "/" in word:
             lines = word.split("/")
@@ -181,88 +633,108 @@ class RenderCog(commands.Cog):
                 letter_mode = 3
         else:
             letter_mode = 4
-        empty = Image.new("RGBA", (24, 24), (0, 0, 0, 0))
+        empty = np.zeros((24, 24, 4), dtype=np.uint8)
         current_y = CUSTOM_HEIGHT[letter_mode]
         if len(lines) > 2:
             current_y -= max((len(lines) - 2) // 6, 9)
         for line in lines:
-            path_sizes = []
+            glyphs = []
             for char in line:
-                path = f"data/special/letters/{char}"
-                char_paths = []
-
-                for char_path in Path(path).glob("*.png"):
-                    if char_path.stem.startswith(str(letter_mode)):
-                        char_paths.append(char_path.stem)
-
-                path_size = [int(path_name[-1]) for path_name in char_paths]
-                path_sizes.append(path_size.copy())
-
-            # this is a mess
-            possible_solutions = itertools.product(*path_sizes)
-            current_solution = None
-            solved_length_dist = 100  # there's absolutely no way that the total length is >109
-            target_length = CUSTOM_WIDTH[letter_mode]
-
-            count = 0
-            for solution in possible_solutions:
-                for i in (1, 2):
-                    count += 1
-                    dist = abs(sum(solution) + i * (len(solution) - 1) - target_length)
-                    if dist == solved_length_dist:
-                        if current_solution is not None:
-                            if current_solution[1] == 2 and i == 1:
-                                current_solution = (solution, i)
-                                solved_length_dist = dist
-                    elif dist < solved_length_dist:
-                        current_solution = (solution, i)
-                        solved_length_dist = dist
-            solution, spacing = current_solution
+                glyph = self.letters.get(char, {}).get(letter_mode)
+                if glyph is None:
+                    raise CustomError(f"There's no letter for `{char}` in custom text.")
+                glyphs.append(glyph)
+            solution, spacing = fit_widths([sorted(glyph) for glyph in glyphs], CUSTOM_WIDTH[letter_mode])
             solved_length = sum(solution) + spacing * (len(solution) - 1)
             if solved_length > 24:
                 raise CustomError("Custom text is too long!")
             current_x = 12 - (solved_length // 2)
-            for i in range(len(solution)):
-                char_length = solution[i]
-                char = line[i]
-                char_path = f"data/special/letters/{char}/{letter_mode}_{char_length}.png"
-                char_img = Image.open(char_path)
-                empty.alpha_composite(char_img, (current_x, current_y))
+            for glyph, char_length in zip(glyphs, solution):
+                alpha_composite(empty, glyph[char_length], current_x, current_y)
                 current_x += char_length + spacing
             current_y += 6
+        empty.flags.writeable = False
+        self.text_cache[word] = empty
         return empty
 
-    async def render(self, scene: Scene, buffer: BytesIO, flagdata: FlagData):
-        """Renders a scene into a buffer."""
-        frames: list[Image.Image] = await self.render_scene(scene, flagdata)
-        kwargs = {
-            'format': "GIF",
-            'interlace': True,
-            'save_all': True,
-            'append_images': frames[1:],
-            'loop': 0,
-            'duration': 500,
-            'optimize': False,
-            'disposal': 2
-        }
-        frames[0].save(
-            buffer,
-            **kwargs
-        )
+    def render(
+            self, scene: Scene | ColumnarScene, buffer: io.BytesIO, flagdata: FlagData,
+            previous: tuple[ColumnarScene, list[np.ndarray]] | None = None
+    ) -> list[np.ndarray]:
+        """Renders a scene into a buffer, returning its frames. This blocks, so the bot sends it through the render executor.
+
+        Given the scene and frames of an earlier render, only what changed since then is redrawn."""
+        if previous is None:
+            frames = self.render_scene(scene, flagdata)
+        else:
+            frames = self.render_changes(scene, flagdata, previous)
+        with tracing.span("encode"):
+            encode(frames, buffer, flagdata.format)
+        return frames
 
     @commands.command(name="render", aliases=["r", "t", "tile"])
     async def render_tiles(self, ctx, *, objs: str):
+        with tracing.trace("render", ctx.message.id) as trace:
+            flagdata = FlagData()
+            with trace.span("parse"):
+                scene = self.bot.parser.parse_columns(objs, flagdata)
+            recent = self.recent.get(ctx.message.id)
+            previous = None
+            if recent is not None and recent.frames is not None and recent.flagdata == flagdata:
+                previous = (recent.scene, recent.frames)
+            # Cached renders don't need a turn, so they skip straight to being sent
+            key, result = self.bot.executor.cached(scene, flagdata)
+            frames = None
+            if result is None:
+                width, height = self.frame_size(scene)
+                cost = scheduler.estimate(scene, width, height).seconds
+                # Kept alongside the stages, so that it can be compared with how long rendering actually took
+                trace.add("estimate", cost)
+                # Only worth sending back if it'd fit alongside a few others
+                keep_frames = width * height * 4 * 3 <= config.edit_cache_size // 4
+                guild = ctx.guild.id if ctx.guild is not None else None
+                start = time.perf_counter()
+                async with self.bot.executor.scheduler.slot(guild, ctx.author.id, cost) as ticket:
+                    trace.add("wait", time.perf_counter() - start)
+                    result, frames = await self.bot.executor.render(scene, flagdata, previous, keep_frames, ticket, key)
+            buf = io.BytesIO(result)
+            filename = datetime.utcnow().strftime(
+                f"render_%Y-%m-%d_%H.%M.%S.{flagdata.format}"
+            )
+            # TODO: Command parroting
+            with trace.span("send"):
+                file = discord.File(buf, filename)
+                if recent is not None:
+                    reply = recent.reply
+                    await reply.edit(attachments=[file])
+                else:
+                    reply = await ctx.send(file=file)
+            self.recent[ctx.message.id] = RecentRender(scene, flagdata, frames, reply)
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        """Renders edited render commands again, into the message that the last render was sent in."""
+        if before.content == after.content or after.id not in self.recent:
+            return
+        ctx = await self.bot.get_context(after)
+        if ctx.command is not None and ctx.command.qualified_name == self.render_tiles.qualified_name:
+            await self.bot.invoke(ctx)
+
+    @commands.is_owner()
+    @commands.command()
+    async def enginecheck(self, ctx, *, objs: str):
+        """Checks that every compositor renders a scene the same as the PIL one."""
         flagdata = FlagData()
         scene = self.bot.parser.parse(objs, flagdata)
-        buf = io.BytesIO()
-        await self.render(scene, buf, flagdata)
-        buf.seek(0)
-        filename = datetime.utcnow().strftime(
-            f"render_%Y-%m-%d_%H.%M.%S.gif"  # for now - will gif-ify it later
-        )
-        # TODO: Command parroting
-        await ctx.send(file=discord.File(buf, filename))
+        differences = await asyncio.to_thread(self.compare_engines, scene, flagdata)
+        lines = [
+            f"`{engine}`: " + ("matches" if not any(counts) else f"differs by {counts} pixels per frame")
+            for engine, counts in differences.items()
+        ]
+        await ctx.send("\n".join(lines))
 
 
 async def setup(bot: commands.Bot):
-    await bot.add_cog(RenderCog(bot))
+    cog = RenderCog(bot)
+    await bot.add_cog(cog)
+    bot.renderer = cog
@@ -1,14 +1,19 @@
 import math
-from typing import TYPE_CHECKING
-from unittest.util import sorted_list_difference
+import time
+from typing import TYPE_CHECKING, Iterable
+from functools import cached_property
 
-import cv2
 import numpy as np
 from PIL import Image
+from attrs import evolve
 from discord.ext import commands
 
-from classes import Tile, CustomError
-import constants
+from classes import Tile, Variant, CustomError
+import config
+import tracing
+from cache import LRUCache, image_size
+from colors import ColorRegistry, ColorStats
+from compositor import alpha_composite
 
 if TYPE_CHECKING:
     from ROBOT import Bot
@@ -16,7 +21,7 @@ else:
     class Bot:
         pass
 
-META_LIMIT = 16
+META_LIMIT = 64
 META_KERNEL = np.array([
     [0, 1, 0],
     [1, -4, 1],
@@ -30,10 +35,73 @@ DIRECTION_VALUES = {
     "l":3
 }
 
+# Sprite variants, by every name they can be written as
+SPRITE_VARIANTS = {
+    "meta": "meta",
+    "m": "meta",
+    "clean": "clean",
+    "cl": "clean",
+    "color": "color",
+    "c": "color",
+    "inactive": "inactive",
+    "in": "inactive",
+    "property": "property",
+    "prop": "property",
+    "noun": "noun",
+    "unprop": "noun",
+    "grayscale": "grayscale",
+    "gscale": "grayscale",
+    "gs": "grayscale"
+}
+
+
+def meta(arr: np.ndarray, level: int, color: np.ndarray) -> np.ndarray:
+    """Draws the meta rings around an RGBA array, padding it by the level.
+
+    Filtering with META_KERNEL level times leaves, outside of the sprite, the rings that are at most the level away from it
+    and an even distance from the level. With only fully opaque or fully clear alpha, that's worked out straight
+    from a distance transform, so that every level costs the same. Anything else is filtered like it's written."""
+    # OpenCV takes a while to import, and only some variants need it
+    import cv2
+    arr = np.pad(arr, ((level, level), (level, level), (0, 0)))
+    alpha = arr[..., 3]
+    mask = alpha > 0
+    if ((alpha == 0) | (alpha == 255)).all():
+        distance = cv2.distanceTransform((~mask).astype(np.uint8), cv2.DIST_L1, 3)
+        rings = (distance <= level) & (distance % 2 == level % 2)
+        base = np.where(rings[..., np.newaxis], color, 0).astype(np.uint8)
+    else:
+        base = alpha
+        for _ in range(level):
+            base = cv2.filter2D(src=base, ddepth=-1, kernel=META_KERNEL)
+        base = np.dstack((base, base, base, base))
+        base = base.astype(float) / 255
+        base *= color
+        base = base.astype(np.uint8)
+    if not (level % 2):
+        base[mask, ...] = arr[mask, ...]
+    else:
+        base[mask, ...] = 0
+    return base
+
+
 INACTIVE_COLOR = (200, 200, 200, 255)
 BLACK_COLOR = (8,8,8,255)
 WHITE_COLOR = (255,255,255,255)
 
+# Lookup tables are indexed as lut[channel, value]
+LUT_CHANNELS = np.arange(4)
+LUT_VALUES = np.arange(256)[:, np.newaxis]
+
+
+def tint_lut(color) -> np.ndarray:
+    """Gets the lookup table that multiplies each channel by a color, the same way that recolor does."""
+    return np.multiply(LUT_VALUES, np.array(color) / 255).astype(np.uint8).T
+
+
+INACTIVE_LUT = tint_lut(INACTIVE_COLOR)
+BLACK_LUT = tint_lut(BLACK_COLOR)
+
 
 # noinspection PyMethodMayBeStatic
 class VariantCog(commands.Cog):
@@ -41,8 +109,27 @@ class VariantCog(commands.Cog):
 
     bot: Bot
 
-    palette = np.array(Image.open("data/palette.png"), dtype=np.uint8)
-    plate = Image.open("data/custom/sprites/plate_1.png")
+    """Sprites with their variants applied, keyed by (sprite key, variants)."""
+    variant_cache: LRUCache
+
+    """Meta variant results and the color statistics they were made with, keyed by the sprite's contents and the level."""
+    meta_cache: LRUCache
+
+    """Every color that the color variant can be given, for every palette."""
+    colors: ColorRegistry
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.variant_cache = LRUCache(config.variant_cache_size, image_size)
+        # Counting the key too, since that's the whole sprite
+        self.meta_cache = LRUCache(config.meta_cache_size, lambda entry: entry[0].nbytes * 2)
+        self.colors = ColorRegistry.load()
+
+    @cached_property
+    def plate(self) -> np.ndarray:
+        """The plate that the property variant puts sprites on, loaded the first time it's needed."""
+        with Image.open("data/custom/sprites/plate_1.png") as im:
+            return np.array(im.convert("RGBA"))
 
     def handle_tile_variants(self, tile: Tile) -> Tile:
         """Handle all tile variants, removing them from the list."""
@@ -63,10 +150,8 @@ class VariantCog(commands.Cog):
                 tile.y += y
                 tile.z += z
             elif variant.name == "unit":
-                if tile.data.unit:
-                    tile.data.unit = False
-                else:
-                    tile.data.unit = True
+                # Tiles share their data, so this needs its own copy
+                tile.data = evolve(tile.data, unit=not tile.data.unit)
             elif variant.name in ("u", "l", "d", "r"):
                 dir_value = DIRECTION_VALUES[variant.name]
                 tile.direction = dir_value
@@ -75,135 +160,124 @@ class VariantCog(commands.Cog):
         tile.running_variants = new_variants
         return tile
 
-    def handle_sprite_variants(self, tile: Tile, image: Image.Image) -> Image.Image:
-        """Handle all sprite variants, removing them from the list."""
-        new_variants = []
+    def handle_sprite_variants(self, variants: list[Variant], image: np.ndarray, sprite_key: tuple, palette: str) -> np.ndarray:
+        """Handle all sprite variants of a tile, skipping any others.
+
+        The result is cached under the sprite's key, the variants and the palette, so don't modify it."""
+        variants = tuple(
+            (SPRITE_VARIANTS[variant.name], tuple(variant.arguments))
+            for variant in variants
+            if variant.name in SPRITE_VARIANTS
+        )
+        if not len(variants):
+            return image
+        key = (sprite_key, variants, palette)
+        result = self.variant_cache.get(key)
+        if result is None:
+            result = self.apply_sprite_variants(variants, image, palette, sprite_key)
+            self.variant_cache[key] = result
+        return result
+
+    def check_colors(self, chains: Iterable[list[Variant]], palette: str):
+        """Resolves every color argument in some variant chains at once, so that a bad one is caught before rendering."""
+        self.colors.resolve_many((
+            variant.arguments[0]
+            for chain in chains
+            for variant in chain
+            if SPRITE_VARIANTS.get(variant.name) == "color" and len(variant.arguments) == 1
+        ), palette)
+
+    def apply_sprite_variants(
+            self, variants: tuple[tuple[str, tuple[str, ...]], ...], image: np.ndarray, palette: str = "default",
+            sprite_key: tuple | None = None
+    ) -> np.ndarray:
+        """Applies a chain of (name, arguments) sprite variants to a sprite.
 
-        sorted_colors: np.ndarray = None
+        Variants that change each channel on its own are composed into one lookup table,
+        which is only applied once something needs the pixels.
+        Given the sprite's key, the color statistics of the sprite itself come from the renderer instead of being counted."""
+        stats: ColorStats | None = None
+        arr = np.asarray(image)
+        lut: np.ndarray | None = None
 
-        # This is done so that we only sort when it's needed,
+        def flush():
+            nonlocal arr, lut
+            if lut is not None:
+                arr = lut[LUT_CHANNELS, arr]
+                lut = None
+
+        def apply_lut(step: np.ndarray):
+            nonlocal lut
+            lut = step if lut is None else step[LUT_CHANNELS[:, np.newaxis], lut]
+
+        # This is done so that we only count colors when it's needed,
         # but it's convenient to when it IS needed
-        def sort_colors():
-            nonlocal sorted_colors
-            if sorted_colors is None:
-                array = np.array(image)
-                colors = array.reshape(-1, 4)
-                colors = colors[colors[..., 3] != 0]
-                (colors, counts) = np.unique(colors, axis=0, return_counts=True)
-                sorted_colors = colors[np.argsort(counts)[::-1]]
-        
-        for variant in tile.running_variants:
-            print(variant)
-            if variant.name in ("meta", "m"):
-                sort_colors()
+        def count_colors() -> ColorStats:
+            nonlocal stats
+            if stats is None:
+                flush()
+                if arr is image and sprite_key is not None:
+                    stats = self.bot.renderer.color_stats(sprite_key)
+                else:
+                    stats = ColorStats.of(arr)
+            return stats
+
+        trace = tracing.current()
+        for name, arguments in variants:
+            start = time.perf_counter()
+            if name == "meta":
                 level = 1
-                if len(variant.arguments):
+                if len(arguments):
                     try:
-                        level = int(variant.arguments[0])
+                        level = int(arguments[0])
                     except ValueError:
                         raise CustomError("Meta level must be an integer!")
                 if level < 1:
                     raise CustomError("Meta level must be positive!")
                 if level > META_LIMIT:
                     raise CustomError(f"Meta level can't be greater than {META_LIMIT}!")
-                arr = np.array(image, dtype=np.uint8)
-                arr = np.pad(arr, ((level,level), (level,level), (0,0)))
-                base = arr[..., 3]
-                for _ in range(level):
-                    base = cv2.filter2D(src=base, ddepth=-1, kernel=META_KERNEL)
-                base = np.dstack((base, base, base, base))
-                base = base.astype(float) / 255
-                base *= sorted_colors[0]
-                base = base.astype(np.uint8)
-                mask = arr[..., 3] > 0
-                if not (level % 2) and level > 0:
-                    base[mask, ...] = arr[mask, ...]
-                else:
-                    base[mask, ...] = 0
-                image = Image.fromarray(base)
-            elif variant.name in ("clean", "cl"):
-                sort_colors()
-                r_max = 0
-                g_max = 0
-                b_max = 0
-                for color in sorted_colors:
-                    if color[0] > r_max:
-                        r_max = color[0]
-                    if color[1] > g_max:
-                        g_max = color[1]
-                    if color[2] > b_max:
-                        b_max = color[2]
-                arr = np.array(image, dtype=np.uint8)
-                max_color = (r_max/255, g_max/255, b_max/255, 1)
-                arr = np.divide(arr, max_color, casting = "unsafe")
-                arr = np.array(arr, dtype=np.uint8)
-                image = Image.fromarray(arr)
-            elif variant.name in ("color", "c"):
-                if len(variant.arguments) != 1:
-                    if len(variant.arguments) == 2:
+                flush()
+                key = (arr.shape, arr.tobytes(), level, None if stats is None else stats.colors.tobytes())
+                entry = self.meta_cache.get(key)
+                if entry is None:
+                    entry = (meta(arr, level, count_colors().dominant), stats)
+                    entry[0].flags.writeable = False
+                    self.meta_cache[key] = entry
+                # The statistics are kept so that a hit leaves them how counting would have
+                arr, stats = entry
+            elif name == "clean":
+                max_color = (*(count_colors().maxima / 255), 1)
+                apply_lut(np.array(np.divide(LUT_VALUES, max_color), dtype=np.uint8).T)
+            elif name == "color":
+                if len(arguments) != 1:
+                    if len(arguments) == 2:
                         raise CustomError("You need 1 argument, the color. If you put in 2, you're probably getting confused with RiC.")
                     raise CustomError("You need 1 argument, the color. There's nothing else special here.")
-                arr = np.array(image, dtype=np.uint8)
-                value = variant.arguments[0]
-                if value.startswith("#"):
-                    color_string = value[1:]
-                    color_int = int(color_string, base=16)
-                    color = ((color_int & 0xFF0000) >> 16, (color_int & 0xFF00) >> 8, color_int & 0xFF, 0xFF)
-                elif value[1] == ",":
-                    try:
-                        color_x = int(value[0])
-                        color_y = int(value[2])
-                    except:
-                        raise CustomError("The x and y of the color have to be integers!")
-                    try:
-                        color = self.palette[color_y, color_x]
-                    except:
-                        raise CustomError("Palette index out of bounds.")
-                elif value in constants.COLOR_NAMES:
-                    color_x,color_y = constants.COLOR_NAMES[value]
-                    color = self.palette[color_y, color_x]
-                arr = np.multiply(arr, np.array(color) / 255, casting="unsafe").astype(np.uint8)
-                image = Image.fromarray(arr)
-            elif variant.name in ("inactive", "in"):
-                arr = np.array(image, dtype=np.uint8)
-                color = INACTIVE_COLOR
-                arr = np.multiply(arr, np.array(color) / 255, casting="unsafe").astype(np.uint8)
-                image = Image.fromarray(arr)
-            elif variant.name in ("property", "prop"):
-                arr = np.array(image, dtype=np.uint8)
-                color = BLACK_COLOR
-                arr = np.multiply(arr, np.array(color) / 255, casting="unsafe").astype(np.uint8)
-                img_new = Image.fromarray(arr)
+                apply_lut(tint_lut(self.colors.resolve(arguments[0], palette)))
+            elif name == "inactive":
+                apply_lut(INACTIVE_LUT)
+            elif name == "property":
+                apply_lut(BLACK_LUT)
+                flush()
                 plate = self.plate.copy()
-                plate.alpha_composite(img_new)
-                image = plate
-            elif variant.name in ("noun", "unprop"):
-                sort_colors()
-                arr = np.array(image, dtype=np.uint8)
-                min_color_sum = 765
-                min_color = (255,255,255,255)
-                for color in sorted_colors:
-                    if color[3] > 0:
-                        print(color, sum(color[:3]))
-                        if sum(color[:3]) < min_color_sum:
-                            min_color_sum = sum(color[:3])
-                            min_color = color
+                alpha_composite(plate, arr, 0, 0)
+                arr = plate
+            elif name == "noun":
+                min_color = count_colors().darkest
+                flush()
+                arr = arr.copy()
                 arr[arr[...] != min_color] = 255
                 arr[arr[..., 0] == 255] = 0
                 arr[arr[..., 3] > 0] = 255
-                image = Image.fromarray(arr)
-            elif variant.name in ("gs", "gscale", "grayscale"):
-                arr = np.array(image, dtype=np.uint8)
+            elif name == "grayscale":
+                flush()
                 arr = arr.astype(np.uint16)
-                gray = (arr[..., 0] + arr[..., 1] + arr[..., 2]) // 3 
+                gray = (arr[..., 0] + arr[..., 1] + arr[..., 2]) // 3
                 arr[..., 0], arr[..., 1], arr[..., 2] = gray, gray, gray
                 arr = arr.astype(np.uint8)
-                image = Image.fromarray(arr)
-            else:
-                new_variants.append(variant)
-        tile.running_variants = new_variants
-        return image
-
+            trace.add(f"variant.{name}", time.perf_counter() - start)
+        flush()
+        return arr
 
 async def setup(bot: Bot):
     cog = VariantCog(bot)
@@ -0,0 +1,123 @@
+import re
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from attrs import define
+
+import constants
+from classes import CustomError
+
+CELL_PATTERN = re.compile(r"(\d+),(\d+)")
+HEX_PATTERN = re.compile(r"#[0-9a-fA-F]+")
+
+
+class ColorRegistry:
+    """Every color that a color argument can name, for every palette.
+
+    Colors are written as #rrggbb, as x,y on the palette, or by name."""
+
+    def __init__(self, palettes: dict[str, np.ndarray]):
+        self.palettes = palettes
+        # The colors that don't depend on what's asked for at runtime, by palette and then by how they're written
+        self.colors: dict[str, dict[str, tuple[int, int, int, int]]] = {}
+        for name, palette in palettes.items():
+            colors = {
+                f"{x},{y}": tuple(int(channel) for channel in palette[y, x])
+                for y in range(palette.shape[0])
+                for x in range(palette.shape[1])
+            }
+            for color_name, (x, y) in constants.COLOR_NAMES.items():
+                if x < palette.shape[1] and y < palette.shape[0]:
+                    colors[color_name] = colors[f"{x},{y}"]
+            self.colors[name] = colors
+
+    @classmethod
+    def load(cls, directory: Path = Path("data")):
+        """Loads the default palette, and any others in the palettes directory by their file names."""
+        palettes = {"default": np.array(Image.open(directory / "palette.png").convert("RGBA"), dtype=np.uint8)}
+        for path in sorted((directory / "palettes").glob("*.png")):
+            palettes[path.stem] = np.array(Image.open(path).convert("RGBA"), dtype=np.uint8)
+        return cls(palettes)
+
+    def check_palette(self, palette: str):
+        if palette not in self.palettes:
+            raise CustomError(f"There's no palette called `{palette}`. Try one of {', '.join(self.palettes)}.")
+
+    def resolve(self, value: str, palette: str = "default") -> tuple[int, int, int, int]:
+        """Gets the RGBA of a color argument."""
+        return self.resolve_many([value], palette)[value]
+
+    def resolve_many(self, values, palette: str = "default") -> dict[str, tuple[int, int, int, int]]:
+        """Gets the RGBA of every one of some color arguments at once."""
+        self.check_palette(palette)
+        colors = self.colors[palette]
+        resolved = {}
+        hex_values = []
+        for value in set(values):
+            if value in colors:
+                resolved[value] = colors[value]
+            elif HEX_PATTERN.fullmatch(value):
+                hex_values.append(value)
+            elif CELL_PATTERN.fullmatch(value):
+                raise CustomError("Palette index out of bounds.")
+            else:
+                raise CustomError(f"There's no color called `{value}`.")
+        if len(hex_values):
+            # Only the last six digits count
+            ints = np.array([int(value[1:], base=16) & 0xFFFFFF for value in hex_values], dtype=np.uint32)
+            channels = np.stack(((ints >> 16) & 0xFF, (ints >> 8) & 0xFF, ints & 0xFF), axis=-1).tolist()
+            for value, (r, g, b) in zip(hex_values, channels):
+                resolved[value] = (r, g, b, 0xFF)
+        return resolved
+
+
+def pack_colors(arr: np.ndarray) -> np.ndarray:
+    """Packs each pixel of an RGBA array into a 0xRRGGBBAA integer, which sort in the same order as the pixels would."""
+    return np.ascontiguousarray(arr, dtype=np.uint8).reshape(-1, 4).view(">u4").ravel().astype(np.uint32)
+
+
+def unpack_colors(packed: np.ndarray) -> np.ndarray:
+    """Turns 0xRRGGBBAA integers back into RGBA rows."""
+    return np.asarray(packed, dtype=">u4").view(np.uint8).reshape(-1, 4)
+
+
+@define
+class ColorStats:
+    """How the colors of a sprite's visible pixels are spread, so that variants don't have to count them every time."""
+
+    """Every color, packed as 0xRRGGBBAA, from the most common to the least."""
+    colors: np.ndarray
+
+    """How many pixels have each color."""
+    counts: np.ndarray
+
+    """The most common color, as RGBA. Clear if the sprite is."""
+    dominant: np.ndarray
+
+    """The color with the lowest sum of RGB, the most common one on a tie. White if nothing's darker."""
+    darkest: np.ndarray
+
+    """The highest R, G and B of any color."""
+    maxima: np.ndarray
+
+    @classmethod
+    def from_histogram(cls, colors: np.ndarray, counts: np.ndarray):
+        """Works out the rest from the packed colors and their counts, from the most common to the least."""
+        rgba = unpack_colors(colors)
+        if not len(rgba):
+            clear = np.zeros(4, dtype=np.uint8)
+            return cls(colors, counts, clear, np.full(4, 255, dtype=np.uint8), clear[:3])
+        sums = rgba[:, :3].sum(axis=1, dtype=np.int64)
+        darkest = rgba[np.argmin(sums)] if sums.min() < 255 * 3 else np.full(4, 255, dtype=np.uint8)
+        return cls(colors, counts, rgba[0], darkest, rgba[:, :3].max(axis=0))
+
+    @classmethod
+    def of(cls, arr: np.ndarray):
+        """Counts the colors of an RGBA array's pixels that aren't fully clear."""
+        packed = pack_colors(arr)
+        packed = packed[(packed & 0xFF) != 0]
+        colors, counts = np.unique(packed, return_counts=True)
+        # Packed colors sort like rows do, so ties end up in the same order as sorting the pixels as rows would
+        order = np.argsort(counts)[::-1]
+        return cls.from_histogram(colors[order], counts[order])
@@ -0,0 +1,275 @@
+import numpy as np
+from PIL import Image
+
+from cache import LRUCache
+
+UNIT_KERNEL: np.ndarray = np.array([
+    [0, 1, 0],
+    [1, -6, 1],
+    [1, 1, 1]
+])
+
+OUTLINE_COLOR = (8, 8, 8, 255)
+
+
+def recolor(sprite: Image.Image | np.ndarray, rgba: tuple[int, int, int, int]) -> Image.Image | np.ndarray:
+    """Apply rgba color multiplication. (0-255)"""
+    arr = np.multiply(sprite, np.array(rgba) / 255, casting="unsafe").astype(np.uint8)
+    if isinstance(sprite, np.ndarray):
+        return arr
+    return Image.fromarray(arr)
+
+
+# What recolor gives for each outline strength, so outlines can be colored by indexing into it
+OUTLINE_LUT: np.ndarray = recolor(np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis], 4, axis=1), OUTLINE_COLOR)
+
+
+def outline(arr: np.ndarray) -> np.ndarray:
+    """Gets the outline around an RGBA array, padded by a pixel on each side."""
+    arr = np.pad(arr, ((1, 1), (1, 1), (0, 0)))
+    return outline_region(arr, 0, arr.shape[0], 0, arr.shape[1])
+
+
+def outline_region(padded: np.ndarray, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+    """Gets outline(arr)[top:bottom, left:right], given arr already padded by a pixel on each side.
+
+    Only the region and a pixel around it are looked at, so this is how outlines get redone where something changed."""
+    # Imported here, so that importing this module doesn't wait on OpenCV
+    import cv2
+    height, width = padded.shape[:2]
+    context_top, context_left = max(top - 1, 0), max(left - 1, 0)
+    alpha = padded[context_top:min(bottom + 1, height), context_left:min(right + 1, width), 3]
+    # Past the edges, the filter reflects what's inside, which is why the edges of the whole array are kept intact
+    base = cv2.filter2D(src=alpha, ddepth=-1, kernel=UNIT_KERNEL)
+    base = base[top - context_top:bottom - context_top, left - context_left:right - context_left]
+    base[padded[top:bottom, left:right, 3] > 0] = 0
+    return OUTLINE_LUT[base]
+
+
+def clip(dst: np.ndarray, src: np.ndarray, x: int, y: int) -> tuple[tuple[slice, slice], tuple[slice, slice]] | None:
+    """Gets the slices of dst and src that overlap when src's top left corner is at (x, y), if they do."""
+    height, width = dst.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + src.shape[1], width), min(y + src.shape[0], height)
+    if left >= right or top >= bottom:
+        return None
+    return (slice(top, bottom), slice(left, right)), (slice(top - y, bottom - y), slice(left - x, right - x))
+
+
+def alpha_composite(dst: np.ndarray, src: np.ndarray, x: int, y: int):
+    """Blends an RGBA array over another in place, with its top left corner at (x, y).
+
+    This uses the same fixed point maths as PIL's Image.alpha_composite, so the results match it exactly.
+    Anything that falls outside of the destination is cut off."""
+    slices = clip(dst, src, x, y)
+    if slices is None:
+        return
+    dst_view = dst[slices[0]]
+    src = src[slices[1]]
+    # Fully opaque pixels come out as themselves, so they can skip the maths
+    opaque = src[..., 3] == 255
+    dst_view[opaque] = src[opaque]
+    blend_mask = (src[..., 3] != 0) & ~opaque
+    s = src[blend_mask].astype(np.uint32)
+    d = dst_view[blend_mask].astype(np.uint32)
+    blend = d[:, 3] * (255 - s[:, 3])
+    out_a255 = s[:, 3] * 255 + blend
+    coef1 = s[:, 3] * (255 * 255 * 128) // out_a255
+    coef2 = 255 * 128 - coef1
+    tmp = s[:, :3] * coef1[:, None] + d[:, :3] * coef2[:, None] + (0x80 << 7)
+    out = np.empty_like(s)
+    out[:, :3] = (((tmp >> 8) + tmp) >> 8) >> 7
+    tmp = out_a255 + 0x80
+    out[:, 3] = ((tmp >> 8) + tmp) >> 8
+    dst_view[blend_mask] = out
+
+
+def opaque_mask(arr: np.ndarray) -> np.ndarray | None:
+    """Gets where an RGBA array is opaque, if every pixel of it is either fully opaque or fully clear.
+
+    Arrays like that can be copied through the mask instead of blended, which gives the same result."""
+    alpha = arr[..., 3]
+    opaque = alpha == 255
+    if (opaque | (alpha == 0)).all():
+        return opaque[..., np.newaxis]
+    return None
+
+
+class PILCompositor:
+    """Composites frames with PIL, one image operation per tile.
+
+    This is the reference that the other compositors have to match."""
+
+    """Whether tiles that don't animate can be flattened into layers ahead of time."""
+    layers: bool = False
+
+    def __init__(self, width: int, height: int, background: tuple[int, int, int, int], prepared: LRUCache | None = None):
+        """Prepared sprites aren't cached, since this is the reference, so the cache is only taken to match the others."""
+        self.empty = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        background = np.array(Image.new("RGBA", (width, height), background))
+        background[..., :3][background[..., :3] < 0x08] = 0x08
+        self.background = Image.fromarray(background)
+        self.frame = None
+
+    def prepare(self, sprite: np.ndarray, unit: bool) -> tuple[Image.Image, int, int]:
+        """Turns a sprite into something that can be blitted, returning it with its size."""
+        if not unit:
+            sprite = Image.fromarray(sprite)
+        else:
+            sprite = np.array(sprite)
+            base = Image.fromarray(outline(sprite))
+            sprite = Image.fromarray(np.pad(sprite, ((1, 1), (1, 1), (0, 0))))
+            sprite.alpha_composite(base)
+        return sprite, sprite.width, sprite.height
+
+    def frame_size(self) -> tuple[int, int]:
+        return self.empty.size
+
+    def size(self, sprite: Image.Image) -> tuple[int, int]:
+        """Gets the width and height of a prepared sprite."""
+        return sprite.size
+
+    def new_frame(self):
+        self.frame = self.empty.copy()
+
+    def blit(self, sprite: Image.Image, x: int, y: int):
+        self.frame.alpha_composite(sprite, (x, y))
+
+    def finish_frame(self) -> np.ndarray:
+        """Outlines the frame and puts it on the background, returning it as an RGBA array."""
+        frame = np.array(self.frame)
+        base = Image.fromarray(outline(frame))
+        frame = Image.fromarray(np.pad(frame, ((1, 1), (1, 1), (0, 0))))
+        frame.alpha_composite(base)
+        background = self.background.copy()
+        background.alpha_composite(frame)
+        return np.array(background)
+
+
+class NumpyCompositor:
+    """Composites frames as a single RGBA array, blitting sprites into it by slice."""
+
+    """Whether tiles that don't animate can be flattened into layers ahead of time.
+    Layers match PIL exactly as long as the sprites in them are only ever fully opaque or fully clear,
+    so only sprites that layerable allows go in them."""
+    layers: bool = True
+
+    def __init__(self, width: int, height: int, background: tuple[int, int, int, int], prepared: LRUCache | None = None):
+        """Prepared sprites are kept in the given cache, so that later renders can use them too.
+        Without one, they're only kept for this render."""
+        self.background = np.empty((height, width, 4), dtype=np.uint8)
+        self.background[...] = background
+        self.background[..., :3][self.background[..., :3] < 0x08] = 0x08
+        self.frame = None
+        # Sprites are shared between tiles, so each one only needs preparing once.
+        # The sprite is kept in the value so that its id can't be reused while it's there.
+        self.prepared: LRUCache | dict[tuple[int, bool], tuple[np.ndarray, tuple[np.ndarray, np.ndarray | None]]] = \
+            {} if prepared is None else prepared
+        # The last frame's alpha and outline, for finding what of the outline the next frame can keep
+        self.last_alpha: np.ndarray | None = None
+        self.last_outline: np.ndarray | None = None
+        # Whether sprites overlap, keyed by their ids and how far apart they are.
+        # Only sprites that are being drawn get checked, so their ids can't be reused while this is around.
+        self.overlapping: dict[tuple[int, int, int, int], bool] = {}
+
+    def prepare(self, sprite: np.ndarray, unit: bool) -> tuple[tuple[np.ndarray, np.ndarray | None], int, int]:
+        """Turns a sprite into something that can be blitted, returning it with its size."""
+        key = (id(sprite), unit)
+        entry = self.prepared.get(key)
+        if entry is None:
+            arr = np.asarray(sprite)
+            if unit:
+                base = outline(arr)
+                arr = np.pad(arr, ((1, 1), (1, 1), (0, 0)))
+                # The outline never overlaps the sprite, so putting it on top is just filling it in
+                arr = np.where(base[..., 3:] > 0, base, arr)
+            entry = (sprite, (arr, opaque_mask(arr)))
+            self.prepared[key] = entry
+        arr, mask = entry[1]
+        return (arr, mask), arr.shape[1], arr.shape[0]
+
+    def frame_size(self) -> tuple[int, int]:
+        return self.background.shape[1], self.background.shape[0]
+
+    def size(self, sprite: tuple[np.ndarray, np.ndarray | None]) -> tuple[int, int]:
+        """Gets the width and height of a prepared sprite."""
+        return sprite[0].shape[1], sprite[0].shape[0]
+
+    def new_frame(self):
+        # The outline pass pads the frame by a pixel on each side, so leave room for it
+        height, width = self.background.shape[:2]
+        self.frame = np.zeros((height + 2, width + 2, 4), dtype=np.uint8)
+
+    def blit(self, sprite: tuple[np.ndarray, np.ndarray | None], x: int, y: int, dst: np.ndarray | None = None):
+        """Blits a prepared sprite onto the frame, or onto another array if one's given."""
+        if dst is None:
+            dst = self.frame[1:-1, 1:-1]
+        arr, mask = sprite
+        if mask is None:
+            alpha_composite(dst, arr, x, y)
+            return
+        slices = clip(dst, arr, x, y)
+        if slices is not None:
+            np.copyto(dst[slices[0]], arr[slices[1]], where=mask[slices[1]])
+
+    def layerable(self, sprite: tuple[np.ndarray, np.ndarray | None]) -> bool:
+        """Checks whether a prepared sprite can go in a layer, which is when it's only fully opaque or fully clear."""
+        return sprite[1] is not None
+
+    def layer(self, draws: list[tuple[tuple[np.ndarray, np.ndarray | None], int, int]]) -> tuple[tuple[np.ndarray, np.ndarray | None], int, int] | None:
+        """Flattens (sprite, x, y) draws that always happen one after the other into a single draw."""
+        height, width = self.background.shape[:2]
+        left = max(min(x for _, x, _ in draws), 0)
+        top = max(min(y for _, _, y in draws), 0)
+        right = min(max(x + sprite[0].shape[1] for sprite, x, _ in draws), width)
+        bottom = min(max(y + sprite[0].shape[0] for sprite, _, y in draws), height)
+        if left >= right or top >= bottom:
+            return None
+        arr = np.zeros((bottom - top, right - left, 4), dtype=np.uint8)
+        for sprite, x, y in draws:
+            self.blit(sprite, x - left, y - top, arr)
+        return (arr, opaque_mask(arr)), left, top
+
+    def overlaps(self, draw: tuple[tuple[np.ndarray, np.ndarray | None], int, int], other: tuple[tuple[np.ndarray, np.ndarray | None], int, int]) -> bool:
+        """Checks whether two (sprite, x, y) draws cover any of the same pixels."""
+        (arr, _), x, y = draw
+        (other_arr, _), other_x, other_y = other
+        # The same sprites tend to meet the same way all over a scene, so each way is only checked once
+        key = (id(arr), id(other_arr), other_x - x, other_y - y)
+        result = self.overlapping.get(key)
+        if result is None:
+            slices = clip(arr, other_arr, other_x - x, other_y - y)
+            result = slices is not None and bool(((arr[slices[0]][..., 3] > 0) & (other_arr[slices[1]][..., 3] > 0)).any())
+            self.overlapping[key] = result
+        return result
+
+    def finish_frame(self) -> np.ndarray:
+        """Outlines the frame and puts it on the background, returning it as an RGBA array.
+
+        The outline only gets redone around where the alpha changed since the last frame."""
+        alpha = self.frame[..., 3]
+        if self.last_alpha is None or self.last_alpha.shape != alpha.shape:
+            base = outline(self.frame[1:-1, 1:-1])
+        else:
+            changed = alpha != self.last_alpha
+            rows = np.flatnonzero(changed.any(axis=1))
+            base = self.last_outline
+            if len(rows):
+                columns = np.flatnonzero(changed.any(axis=0))
+                # Outlines reach a pixel out from what they're around
+                top, bottom = max(rows[0] - 1, 0), min(rows[-1] + 2, alpha.shape[0])
+                left, right = max(columns[0] - 1, 0), min(columns[-1] + 2, alpha.shape[1])
+                base = base.copy()
+                base[top:bottom, left:right] = outline_region(self.frame, top, bottom, left, right)
+        self.last_alpha = alpha.copy()
+        self.last_outline = base
+        frame = np.where(base[..., 3:] > 0, base, self.frame)
+        background = self.background.copy()
+        alpha_composite(background, frame, 0, 0)
+        return background
+
+
+COMPOSITORS = {
+    "pil": PILCompositor,
+    "numpy": NumpyCompositor
+}
@@ -1,3 +1,50 @@
-cogs = ["coggers.render", "coggers.error", "coggers.owner", "coggers.data", "coggers.parser", "coggers.variants"]
+cogs = ["coggers.render", "coggers.error", "coggers.owner", "coggers.data", "coggers.parser", "coggers.variants", "coggers.executor"]
 
 prefix = "%"
+
+# How many processes renders are done in. 0 renders on a thread in the bot's own process.
+render_workers = 2
+# How long a render can take, in seconds, before it's given up on.
+render_timeout = 30
+# How many renders can be queued or running at once before new ones get turned away.
+render_queue_limit = 8
+# About how many seconds of rendering, by scheduler.estimate, can be running at once before renders wait their turn.
+render_capacity = 10
+# The most seconds of rendering that one render can be estimated at before it's turned away.
+render_cost_limit = 20
+# How many renders one user can have waiting or running at once.
+render_user_limit = 2
+# How many times its share of turns each guild ID gets when renders are waiting. Guilds not listed get 1.
+render_guild_weights = {}
+# How many bytes of decoded sprites each renderer keeps around.
+sprite_cache_size = 64 * 1024 * 1024
+# How many bytes of sprites with variants applied each renderer keeps around.
+variant_cache_size = 64 * 1024 * 1024
+# How many bytes of meta variant results each renderer keeps around.
+meta_cache_size = 16 * 1024 * 1024
+# How many bytes of finished custom text sprites each renderer keeps around.
+text_cache_size = 4 * 1024 * 1024
+# How many bytes of color statistics each renderer keeps around for sprites that aren't in the atlas, custom text included.
+stats_cache_size = 4 * 1024 * 1024
+# How many bytes of sprites made ready to blit, unit outlines included, each renderer keeps around.
+prepared_cache_size = 64 * 1024 * 1024
+# How many bytes of scenes' ground composited into layers each renderer keeps around.
+floor_cache_size = 64 * 1024 * 1024
+# How many bytes of finished renders are kept in memory, so that repeated commands don't render again.
+result_cache_size = 32 * 1024 * 1024
+# A directory to also keep finished renders in, or None to only keep them in memory.
+result_cache_dir = None
+# How many bytes of finished renders can be kept in result_cache_dir.
+result_cache_disk_size = 512 * 1024 * 1024
+# How many bytes of recent renders' frames the bot keeps, so that editing a command only redraws what changed.
+edit_cache_size = 256 * 1024 * 1024
+# About how many bytes compositing a render can take on top of its finished frames. Taller canvases are rendered in strips.
+render_memory_budget = 64 * 1024 * 1024
+# Which compositor renders are done with, from compositor.COMPOSITORS. "pil" is the slower reference.
+render_engine = "numpy"
+# How many of the most rendered tiles' sprites render workers decode and prepare once the bot's connected. 0 doesn't warm them up.
+warmup_sprites = 256
+# A file to keep how often each tile is rendered in between restarts, for picking what to warm up, or None to not keep it.
+usage_file = "usage.json"
+# A file to append every traced command to as a line of JSON, or None to not log them.
+trace_log = None
@@ -0,0 +1,110 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from classes import CustomError
+
+# The file formats that renders can be saved as, by their extension
+FORMATS = ("gif", "png", "webp")
+
+FRAME_DURATION = 500
+SCALE = 2
+
+
+def upscale(arr: np.ndarray, scale: int = SCALE) -> np.ndarray:
+    """Nearest neighbor upscales an array by a whole number."""
+    return arr.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+def palettize(frames: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray, int | None]:
+    """Maps RGBA frames onto one palette shared by all of them.
+
+    Returns the palette indices of each frame, the palette as RGB rows, and the index that's transparent, if any.
+    Like GIF, this only keeps alpha as fully clear or not."""
+    stacked = np.stack(frames)
+    clear = stacked[..., 3] == 0
+    packed = (
+        (stacked[..., 0].astype(np.uint32) << 16)
+        | (stacked[..., 1].astype(np.uint32) << 8)
+        | stacked[..., 2]
+    )
+    # Past any real color, so that it sorts last
+    packed[clear] = 1 << 24
+    colors, indices = np.unique(packed, return_inverse=True)
+    indices = indices.reshape(packed.shape)
+    transparency = None
+    if colors[-1] == 1 << 24:
+        transparency = len(colors) - 1
+    if len(colors) <= 256:
+        palette = np.stack(((colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF), axis=-1).astype(np.uint8)
+        return indices.astype(np.uint8), palette, transparency
+    # Too many colors for one palette, so quantize all of the frames together
+    opaque = Image.fromarray(stacked[..., :3].reshape(-1, stacked.shape[2], 3))
+    quantized = opaque.quantize(255 if transparency is not None else 256, Image.Quantize.MEDIANCUT)
+    indices = np.asarray(quantized).reshape(packed.shape).copy()
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    quantized_palette = np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)[:256]
+    palette[:len(quantized_palette)] = quantized_palette
+    if transparency is not None:
+        transparency = 255
+        indices[clear] = transparency
+    return indices, palette, transparency
+
+
+def encode_gif(frames: list[np.ndarray], buffer: BytesIO):
+    indices, palette, transparency = palettize(frames)
+    images = []
+    for frame in indices:
+        image = Image.fromarray(upscale(frame), "P")
+        image.putpalette(palette.tobytes())
+        images.append(image)
+    kwargs = {
+        'format': "GIF",
+        'interlace': True,
+        'save_all': True,
+        'append_images': images[1:],
+        'loop': 0,
+        'duration': FRAME_DURATION,
+        'optimize': False,
+        # Without anything transparent, frames can be drawn over the last one,
+        # which lets each frame after the first only store the rectangle that changed
+        'disposal': 2 if transparency is not None else 1
+    }
+    if transparency is not None:
+        kwargs['transparency'] = transparency
+    images[0].save(
+        buffer,
+        **kwargs
+    )
+
+
+def encode_animated(frames: list[np.ndarray], buffer: BytesIO, file_format: str):
+    images = [Image.fromarray(upscale(frame)) for frame in frames]
+    kwargs = {
+        'format': file_format,
+        'save_all': True,
+        'append_images': images[1:],
+        'loop': 0,
+        'duration': FRAME_DURATION
+    }
+    if file_format == "WEBP":
+        kwargs['lossless'] = True
+    else:
+        kwargs['disposal'] = 1
+    images[0].save(
+        buffer,
+        **kwargs
+    )
+
+
+def encode(frames: list[np.ndarray], buffer: BytesIO, file_format: str = "gif"):
+    """Encodes RGBA frames into a buffer as an animation, upscaling them as it goes."""
+    if file_format == "gif":
+        encode_gif(frames, buffer)
+    elif file_format == "png":
+        encode_animated(frames, buffer, "PNG")
+    elif file_format == "webp":
+        encode_animated(frames, buffer, "WEBP")
+    else:
+        raise CustomError(f"Can't save as `{file_format}`. Try one of {', '.join(FORMATS)}.")
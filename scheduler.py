@@ -0,0 +1,240 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import numpy as np
+from attrs import define, field
+
+from classes import ColumnarScene, CustomError
+
+# Rough seconds that each part of a scene adds to rendering it, from benchmarks/render.py
+TILE_COST = 1.6e-4
+PIXEL_COST = 2e-8
+META_COST = 2e-4
+META_PIXEL_COST = 2.5e-8
+TEXT_COST = 5e-4
+# Every render has three frames
+FRAMES = 3
+# Most sprites are this many pixels across, before meta pads them
+SPRITE_SIZE = 24
+
+
+@define
+class Cost:
+    """An estimate of how much work rendering a scene is."""
+
+    """How many tiles the scene has."""
+    tiles: int
+
+    """How many pixels every frame of the render adds up to."""
+    pixels: int
+
+    """The meta levels of every distinct sprite, added up."""
+    meta: int
+
+    """How many pixels meta padding adds to what every frame composites, over every tile with it."""
+    meta_pixels: int
+
+    """How many of the tiles are custom text."""
+    text: int
+
+    @property
+    def seconds(self) -> float:
+        """About how long the render would take, in seconds."""
+        return (
+            self.tiles * TILE_COST + self.pixels * PIXEL_COST + self.meta * META_COST
+            + self.meta_pixels * META_PIXEL_COST + self.text * TEXT_COST
+        )
+
+
+def estimate(scene: ColumnarScene, width: int, height: int) -> Cost:
+    """Estimates the cost of rendering a scene at a frame size."""
+    # Variants are cached by sprite, so each chain costs once for every kind of tile it's on
+    pairs = np.unique(scene.chain.astype(np.int64) * len(scene.kinds) + scene.kind)
+    chain_counts = np.bincount(pairs // max(len(scene.kinds), 1), minlength=len(scene.chains))
+    # Every tile with meta composites its sprite padded by the levels on each side
+    tile_counts = np.bincount(scene.chain, minlength=len(scene.chains))
+    meta = 0
+    meta_pixels = 0
+    for count, tiles, chain in zip(chain_counts.tolist(), tile_counts.tolist(), scene.chains):
+        levels = 0
+        for variant in chain:
+            if variant.name in ("meta", "m"):
+                # Bad levels get caught when the variants are applied
+                try:
+                    levels += max(int(variant.arguments[0]) if len(variant.arguments) else 1, 0)
+                except ValueError:
+                    pass
+        meta += count * levels
+        meta_pixels += tiles * ((SPRITE_SIZE + 2 * levels) ** 2 - SPRITE_SIZE ** 2) * FRAMES
+    kind_counts = np.bincount(scene.kind, minlength=len(scene.kinds))
+    text = sum(
+        count
+        for count, (_, data) in zip(kind_counts.tolist(), scene.kinds)
+        if data.directory == "custom_text_"
+    )
+    return Cost(len(scene.x), width * height * FRAMES, meta, meta_pixels, text)
+
+
+@define
+class Ticket:
+    """A render waiting for its turn."""
+
+    """The guild and user it was asked for by."""
+    guild: int
+    user: int
+
+    """Its estimated cost, in seconds."""
+    cost: float
+
+    """Gets a result once it's been let through."""
+    admitted: asyncio.Future = field(factory=lambda: asyncio.get_running_loop().create_future())
+
+    """Work that's still going after the slot is left, which the ticket keeps its place until it's done."""
+    held: asyncio.Future | None = None
+
+
+class Scheduler:
+    """Lets renders through in a fair order, and only as many as there's room for.
+
+    Guilds take turns by deficit round robin, each turn earning them their weight in seconds of rendering,
+    and the users of a guild take turns in that guild's share. Renders are let through while the estimated
+    cost of those already running stays within the capacity."""
+
+    def __init__(
+            self, capacity: float, limit: float, user_limit: int,
+            weights: dict[int, float] | None = None, quantum: float = 1
+    ):
+        """The limit is the most that one render can cost, and the user limit how many renders one user can have at once.
+
+        Every weight has to be positive, since a guild's turns are only ever earned through its weight."""
+        if any(weight <= 0 for weight in (weights or {}).values()):
+            raise ValueError("Guild weights have to be positive.")
+        self.capacity = capacity
+        self.limit = limit
+        self.user_limit = user_limit
+        self.weights = weights or {}
+        self.quantum = quantum
+        # Each guild's users' waiting tickets, with the user whose turn it is first
+        self.queues: dict[int, dict[int, deque[Ticket]]] = {}
+        # The guilds with waiting tickets, with the one whose turn it is first
+        self.guilds: deque[int] = deque()
+        self.deficits: dict[int, float] = {}
+        # How many renders each user has waiting or running
+        self.users: dict[int, int] = {}
+        self.running = 0
+        self.running_cost = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def check(self, user: int, cost: float):
+        """Turns away renders that cost too much, or that a user has too many of."""
+        if cost > self.limit:
+            self.rejected += 1
+            raise CustomError(
+                f"That render is too big! It'd take about {cost:.1f} seconds, and the limit is {self.limit:.0f}."
+            )
+        if self.users.get(user, 0) >= self.user_limit:
+            self.rejected += 1
+            raise CustomError("You already have too many renders going, wait for them to finish first.")
+
+    @asynccontextmanager
+    async def slot(self, guild: int | None, user: int, cost: float) -> AsyncIterator[Ticket]:
+        """Waits for a render's turn, holding its place among the running ones for the body of an async with statement.
+
+        Setting the ticket's held future holds its place past the end of the body, until that's done too."""
+        self.check(user, cost)
+        ticket = Ticket(guild or 0, user, cost)
+        self.users[user] = self.users.get(user, 0) + 1
+        try:
+            self.enqueue(ticket)
+            # Shielded, so that only being let through ever finishes it
+            await asyncio.shield(ticket.admitted)
+        except asyncio.CancelledError:
+            if ticket.admitted.done():
+                self.release(ticket)
+            else:
+                self.remove(ticket)
+                self.leave(user)
+            raise
+        try:
+            yield ticket
+        finally:
+            if ticket.held is not None and not ticket.held.done():
+                ticket.held.add_done_callback(lambda _: self.release(ticket))
+            else:
+                self.release(ticket)
+
+    def enqueue(self, ticket: Ticket):
+        users = self.queues.get(ticket.guild)
+        if users is None:
+            users = self.queues[ticket.guild] = {}
+            self.guilds.append(ticket.guild)
+            self.deficits[ticket.guild] = 0
+        users.setdefault(ticket.user, deque()).append(ticket)
+        self.dispatch()
+
+    def remove(self, ticket: Ticket):
+        users = self.queues[ticket.guild]
+        tickets = users[ticket.user]
+        tickets.remove(ticket)
+        if not len(tickets):
+            del users[ticket.user]
+        if not len(users):
+            self.drop_guild(ticket.guild)
+
+    def release(self, ticket: Ticket):
+        self.running -= 1
+        self.running_cost -= ticket.cost
+        self.leave(ticket.user)
+        self.dispatch()
+
+    def leave(self, user: int):
+        self.users[user] -= 1
+        if not self.users[user]:
+            del self.users[user]
+
+    def drop_guild(self, guild: int):
+        # Guilds don't get to save up turns while they have nothing waiting
+        del self.queues[guild]
+        del self.deficits[guild]
+        self.guilds.remove(guild)
+
+    def dispatch(self):
+        """Lets through every render that's next in line and fits."""
+        while len(self.guilds):
+            guild = self.guilds[0]
+            users = self.queues[guild]
+            user = next(iter(users))
+            ticket = users[user][0]
+            # Anything can run on its own, so that renders bigger than the capacity still get to
+            if self.running and self.running_cost + ticket.cost > self.capacity:
+                return
+            if self.deficits[guild] < ticket.cost:
+                self.deficits[guild] += self.quantum * self.weights.get(guild, 1)
+                self.guilds.rotate(-1)
+                continue
+            self.deficits[guild] -= ticket.cost
+            tickets = users.pop(user)
+            tickets.popleft()
+            # The user goes to the back of their guild's line
+            if len(tickets):
+                users[user] = tickets
+            elif not len(users):
+                self.drop_guild(guild)
+            self.running += 1
+            self.running_cost += ticket.cost
+            self.admitted += 1
+            ticket.admitted.set_result(None)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "queued": sum(len(tickets) for users in self.queues.values() for tickets in users.values()),
+            "running": self.running,
+            "running_cost": self.running_cost,
+            "capacity": self.capacity,
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+
@@ -0,0 +1,176 @@
+"""Serves renders over HTTP without connecting to Discord, going through the same parsing, scheduling and render pool as the bot.
+
+Run from the root of the repository, after setup.py:
+    python serve.py [--host HOST] [--port PORT] [--unix PATH]
+
+    POST /render    The body is a scene string, flags included, like the render command takes.
+                    Responds with the rendered file.
+    POST /batch     The body is a JSON list of scene strings. Responds with a tar stream of render_<index>.<format>,
+                    in order, with render_<index>.txt holding the error instead for scenes that couldn't be rendered.
+    GET  /stats     The p50/p95/p99 of each stage, and the scheduler's counts, as JSON.
+
+Renders are scheduled as the X-Guild and X-User headers, or as the client's address without them.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import tarfile
+import time
+
+from aiohttp import web
+
+import config
+import scheduler
+import tracing
+from classes import CustomError
+from coggers.data import DataCog, FlagData
+from coggers.executor import RenderExecutorCog
+from coggers.parser import ParserCog
+from coggers.render import RenderCog
+from coggers.variants import VariantCog
+
+CONTENT_TYPES = {
+    "gif": "image/gif",
+    "png": "image/png",
+    "webp": "image/webp"
+}
+
+
+class Service:
+    """Stands in for the bot, holding the cogs that rendering goes through."""
+
+    def __init__(self):
+        self.data = DataCog(self)
+        self.data.load_tile_data()
+        self.variant_handler = VariantCog(self)
+        self.parser = ParserCog(self)
+        self.renderer = RenderCog(self)
+        self.executor = RenderExecutorCog(self)
+
+    async def render(self, objs: str, guild: int | None, user: int) -> tuple[bytes, FlagData]:
+        """Renders a scene string like the render command does, returning the file and the flags it was rendered with."""
+        with tracing.trace("serve") as trace:
+            flagdata = FlagData()
+            with trace.span("parse"):
+                scene = self.parser.parse_columns(objs, flagdata)
+            key, result = self.executor.cached(scene, flagdata)
+            if result is not None:
+                return result, flagdata
+            width, height = self.renderer.frame_size(scene)
+            cost = scheduler.estimate(scene, width, height).seconds
+            trace.add("estimate", cost)
+            start = time.perf_counter()
+            async with self.executor.scheduler.slot(guild, user, cost) as ticket:
+                trace.add("wait", time.perf_counter() - start)
+                result, _ = await self.executor.render(scene, flagdata, ticket=ticket, key=key)
+            return result, flagdata
+
+    def client(self, request: web.Request) -> tuple[int | None, int]:
+        """Gets who a request is scheduled as, as (guild, user)."""
+        guild = request.headers.get("X-Guild")
+        user = request.headers.get("X-User")
+        if user is None:
+            # Scheduling only needs something that stays the same for the same client
+            user = int.from_bytes(hashlib.sha256(str(request.remote).encode()).digest()[:8], "big")
+        try:
+            return (int(guild) if guild is not None else None), int(user)
+        except ValueError:
+            raise web.HTTPBadRequest(text="X-Guild and X-User have to be integers.")
+
+    async def handle_render(self, request: web.Request) -> web.Response:
+        guild, user = self.client(request)
+        try:
+            result, flagdata = await self.render(await request.text(), guild, user)
+        except CustomError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.Response(body=result, content_type=CONTENT_TYPES[flagdata.format])
+
+    async def handle_batch(self, request: web.Request) -> web.StreamResponse:
+        guild, user = self.client(request)
+        try:
+            scenes = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="The body has to be a JSON list of scene strings.")
+        if not (isinstance(scenes, list) and all(isinstance(scene, str) for scene in scenes)):
+            raise web.HTTPBadRequest(text="The body has to be a JSON list of scene strings.")
+
+        # Only as many at once as the scheduler lets one user have, so that the batch never gets itself turned away
+        limit = asyncio.Semaphore(config.render_user_limit)
+
+        async def render(objs: str) -> tuple[bytes, FlagData] | Exception:
+            async with limit:
+                try:
+                    return await self.render(objs, guild, user)
+                except Exception as e:
+                    # Anything that goes wrong with one scene only goes in its own entry, so the archive still ends properly
+                    return e
+
+        tasks = [asyncio.create_task(render(objs)) for objs in scenes]
+        response = web.StreamResponse(headers={"Content-Type": "application/x-tar"})
+        await response.prepare(request)
+        try:
+            for i, task in enumerate(tasks):
+                result = await task
+                if isinstance(result, CustomError):
+                    name, body = f"render_{i:04}.txt", str(result).encode()
+                elif isinstance(result, Exception):
+                    name, body = f"render_{i:04}.txt", f"{type(result).__name__}: {result}".encode()
+                else:
+                    name, body = f"render_{i:04}.{result[1].format}", result[0]
+                info = tarfile.TarInfo(name)
+                info.size = len(body)
+                info.mtime = int(time.time())
+                await response.write(info.tobuf(format=tarfile.GNU_FORMAT) + body)
+                # Entries are padded out to whole blocks
+                await response.write(bytes(-len(body) % tarfile.BLOCKSIZE))
+            # An archive ends with two empty blocks
+            await response.write(bytes(tarfile.BLOCKSIZE * 2))
+        finally:
+            for task in tasks:
+                task.cancel()
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "traces": tracing.recorder.traces,
+            "stages": {
+                stage: {"count": count, "p50": p50, "p95": p95, "p99": p99}
+                for stage, (count, p50, p95, p99) in tracing.recorder.percentiles().items()
+            },
+            "scheduler": self.executor.scheduler.stats()
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.add_routes([
+            web.post("/render", self.handle_render),
+            web.post("/batch", self.handle_batch),
+            web.get("/stats", self.handle_stats)
+        ])
+
+        async def shutdown(_):
+            await self.executor.cog_unload()
+
+        app.on_cleanup.append(shutdown)
+        return app
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--host", default="127.0.0.1", help="the address to listen on")
+    arg_parser.add_argument("--port", type=int, default=8080, help="the port to listen on")
+    arg_parser.add_argument("--unix", help="a Unix socket to listen on instead")
+    args = arg_parser.parse_args()
+
+    app = Service().app()
+    if args.unix is not None:
+        web.run_app(app, path=args.unix)
+    else:
+        web.run_app(app, host=args.host, port=args.port)
+
+
+# Render workers may re-import this module when they start, so don't serve for them
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,16 @@ import sys
 from pathlib import Path
 import shutil
 
+from atlas import build_atlas
+
 
 def main():
     args = sys.argv
     if len(args) < 2:
-        print("Usage:\n\tsetup.py <path to MSB install>")
+        print("Usage:\n\tsetup.py <path to MSB install>\n\tsetup.py --atlas (only rebuilds the sprite atlas)")
+        return
+    if args[1] == "--atlas":
+        print(f"Packed {build_atlas()} sprites")
         return
     path = Path(args[1]) / 'Data'
     if Path("data/default").exists():
@@ -19,6 +24,7 @@ def main():
     for file in (path / 'assets' / 'default' / 'sprites').glob('*.png'):
         shutil.copy2(file, "data/default/sprites/")
     shutil.copytree(path / 'assets' / 'default' / 'sprites' / 'terrain', "data/default/sprites/", dirs_exist_ok=True)
+    print(f"Packed {build_atlas()} sprites")
     print("Done")
 
 
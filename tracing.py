@@ -0,0 +1,129 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+import numpy as np
+
+import config
+
+# How many of the latest durations of each stage are kept for working out percentiles
+HISTORY = 1000
+
+
+class Trace:
+    """The time spent in each stage of a single command, in seconds."""
+
+    def __init__(self, command: str, key: int | None = None):
+        """The key tells apart invocations of the command, like the ID of the message that invoked it."""
+        self.command = command
+        self.key = key
+        self.started = time.time()
+        self.failed = False
+        self.stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        """Adds time to a stage. Stages that happen more than once add up."""
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def merge(self, stages: dict[str, float]):
+        for stage, seconds in stages.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        """Times the body of a with statement as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+
+class NullTrace(Trace):
+    """Stands in when nothing's being traced, so that code can time itself without checking first."""
+
+    def add(self, stage: str, seconds: float):
+        pass
+
+
+current_trace: ContextVar[Trace] = ContextVar("current_trace", default=NullTrace("none"))
+
+
+def current() -> Trace:
+    """Gets the trace of the command that's running, which does nothing if there isn't one."""
+    return current_trace.get()
+
+
+def span(stage: str):
+    """Times the body of a with statement as a stage of the current trace."""
+    return current().span(stage)
+
+
+class Recorder:
+    """Keeps the latest durations of every stage across traces, and logs finished traces if configured to."""
+
+    def __init__(self, history: int = HISTORY):
+        self.history = history
+        self.traces = 0
+        self.durations: dict[str, deque[float]] = {}
+
+    def record(self, trace: Trace):
+        self.traces += 1
+        for stage, seconds in trace.stages.items():
+            self.durations.setdefault(stage, deque(maxlen=self.history)).append(seconds)
+        if config.trace_log is not None:
+            with open(config.trace_log, "a") as f:
+                f.write(json.dumps({
+                    "command": trace.command,
+                    "key": trace.key,
+                    "started": trace.started,
+                    "failed": trace.failed,
+                    "stages": trace.stages
+                }) + "\n")
+
+    def percentiles(self) -> dict[str, tuple[int, float, float, float]]:
+        """Gets the count, p50, p95 and p99 of every stage, in seconds."""
+        return {
+            stage: (len(durations), *np.percentile(durations, (50, 95, 99)))
+            for stage, durations in sorted(self.durations.items())
+        }
+
+    def clear(self):
+        self.traces = 0
+        self.durations.clear()
+
+
+recorder = Recorder()
+
+
+@contextmanager
+def trace(command: str, key: int | None = None) -> Iterator[Trace]:
+    """Traces the body of a with statement as a command, recording it once it's done."""
+    new_trace = Trace(command, key)
+    token = current_trace.set(new_trace)
+    start = time.perf_counter()
+    try:
+        yield new_trace
+    except BaseException:
+        new_trace.failed = True
+        raise
+    finally:
+        new_trace.add("total", time.perf_counter() - start)
+        current_trace.reset(token)
+        recorder.record(new_trace)
+
+
+@contextmanager
+def collect() -> Iterator[Trace]:
+    """Traces the body of a with statement without recording it, so its stages can be sent back to the command's trace.
+
+    Render workers use this, since the command's trace is in the bot's process."""
+    new_trace = Trace("collect")
+    token = current_trace.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        current_trace.reset(token)